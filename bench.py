@@ -0,0 +1,448 @@
+import os, sys, asyncio, random, statistics, tempfile, time, argparse, logging, multiprocessing
+from functools import partial
+from types import SimpleNamespace
+
+# fsub.py builds its TelegramClient and Mongo client at import time, so give it
+# harmless settings and keep the session file out of the working tree.
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("MEMBER_CACHE_POSITIVE_TTL", "0")
+os.environ.setdefault("MEMBER_CACHE_NEGATIVE_TTL", "0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="fsub-bench-"))
+
+import fsub
+fsub.logger.setLevel(logging.ERROR)
+from telethon.tl.functions.channels import GetParticipantRequest
+from telethon.errors import FloodWaitError
+from telethon.errors.rpcerrorlist import UserNotParticipantError
+from pymongo.errors import AutoReconnect
+
+try:
+    from mongomock_motor import AsyncMongoMockClient
+except ImportError:  # only the scenarios need it
+    AsyncMongoMockClient = None
+
+# Fake Telegram client: every RPC sleeps for a random delay around `latency`, spins
+# the CPU for `cpu` seconds (the work of handling one reply), and fails with a flood
+# wait of `flood_seconds` with probability `flood_rate`. Requests
+# go through the bot's RpcGateway, so rate limits, priorities and flood-wait retries
+# cost what they would against Telegram.
+class FakeClient:
+    def __init__(self, latency=0.05, jitter=0.02, members=None, flood_rate=0.0, flood_seconds=1, cpu=0.0):
+        self.gateway = fsub.RpcGateway(fsub.RPC_RATE, fsub.RPC_SEND_RATE)
+        self.latency = latency
+        self.cpu = cpu
+        self.jitter = jitter
+        self.members = members  # set of (user_id, channel_id) pairs, None means everyone joined
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rpc_count = 0
+        self.flood_waits = 0
+        self.sent_messages = 0
+
+    async def _delay(self, method):
+        await self.gateway.call(method, self._rpc)
+
+    async def _rpc(self):
+        self.rpc_count += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if self.cpu:
+            busy_until = time.perf_counter() + self.cpu
+            while time.perf_counter() < busy_until:
+                pass
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(None, capture=self.flood_seconds)
+
+    async def __call__(self, request):
+        await self._delay(type(request).__name__)
+        if isinstance(request, GetParticipantRequest):
+            key = (request.participant, request.channel)
+            if self.members is not None and key not in self.members:
+                raise UserNotParticipantError(request)
+        return None
+
+    async def get_entity(self, ref):
+        await self._delay("GetChannelsRequest")
+        return ref
+
+    async def send_message(self, *args, method="SendMessageRequest", **kwargs):
+        await self._delay(method)
+        self.sent_messages += 1
+        return SimpleNamespace(id=self.sent_messages)
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self._delay("DeleteMessagesRequest")
+
+    async def forward_messages(self, *args, **kwargs):
+        return await self.send_message(method="ForwardMessagesRequest")
+
+    async def pin_message(self, *args, **kwargs):
+        await self._delay("UpdatePinnedMessageRequest")
+
+    async def edit_message(self, *args, **kwargs):
+        await self._delay("EditMessageRequest")
+
+# In-memory Mongo stand-in that counts every collection call as one DB op. Calls
+# other than find/aggregate (cursors) can be slowed down by db["latency"] seconds and
+# fail with AutoReconnect at db["error_rate"], to load the write-behind and retry paths.
+CURSOR_METHODS = {"find", "aggregate"}
+DB_METHODS = {
+    "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many",
+    "find_one_and_delete", "bulk_write", "count_documents", "estimated_document_count", "create_index", "aggregate",
+}
+
+class CountingCollection:
+    def __init__(self, collection, stats):
+        self.collection = collection
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if name not in DB_METHODS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self.stats["db_ops"] += 1
+            if name in CURSOR_METHODS or not (self.stats["latency"] or self.stats["error_rate"]):
+                return attr(*args, **kwargs)
+            return self.degraded(attr, args, kwargs)
+        return counted
+
+    async def degraded(self, attr, args, kwargs):
+        if self.stats["latency"]:
+            await asyncio.sleep(max(0.0, random.gauss(self.stats["latency"], self.stats["latency"] / 4)))
+        if random.random() < self.stats["error_rate"]:
+            self.stats["db_errors"] += 1
+            raise AutoReconnect("injected by bench")
+        return await attr(*args, **kwargs)
+
+def install_fake_db():
+    stats = {"db_ops": 0, "db_errors": 0, "latency": 0.0, "error_rate": 0.0}
+    db = AsyncMongoMockClient().fsub
+    names = {
+        "users_collection": "users", "groups_collection": "groups", "forcesub_collection": "forcesubs",
+        "banned_users_collection": "banned_users", "broadcasts_collection": "broadcasts", "stats_collection": "stats",
+        "enforcement_stats_collection": "enforcement_stats",
+    }
+    for attr, name in names.items():
+        setattr(fsub, attr, CountingCollection(db[name], stats))
+    # Module-level objects that captured the real collections
+    fsub.user_tracker = fsub.SeenTracker(fsub.users_collection, "user_id", "users")
+    fsub.group_tracker = fsub.SeenTracker(fsub.groups_collection, "group_id", "groups")
+    fsub.daily_activity = fsub.DailyActivity()
+    fsub.enforcement_stats = fsub.EnforcementStats(fsub.enforcement_stats_collection)
+    fsub.UNIQUE_INDEXES = (
+        (fsub.users_collection, "user_id"),
+        (fsub.groups_collection, "group_id"),
+        (fsub.forcesub_collection, "chat_id"),
+        (fsub.banned_users_collection, "user_id"),
+    )
+    fsub.BROADCAST_STAGES = (("groups", fsub.groups_collection, "group_id"), ("users", fsub.users_collection, "user_id"))
+    return stats
+
+class FakeEvent:
+    def __init__(self, chat_id, sender_id, text="hello", message_id=1):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.text = text
+        self.is_group = True
+        self.is_private = False
+        self.sender = SimpleNamespace(id=sender_id, first_name="Bench", username=None)
+
+    async def delete(self):
+        await fsub.app._delay("DeleteMessagesRequest")
+
+    async def reply(self, *args, **kwargs):
+        await fsub.app._delay("SendMessageRequest")
+
+    async def get_sender(self):
+        return self.sender
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def report(name, samples):
+    print(f"{name}: n={len(samples)} p50={percentile(samples, 50) * 1000:.1f}ms "
+          f"p99={percentile(samples, 99) * 1000:.1f}ms mean={statistics.mean(samples) * 1000:.1f}ms")
+
+# Latency of one force-sub check (what a queue worker runs per group message)
+async def bench_multi_channel_check(messages, channels, latency, missing_ratio):
+    chat_id = -1001000000001
+    channel_ids = [-1002000000000 - i for i in range(channels)]
+    fsub.forcesub_cache[chat_id] = {
+        "chat_id": chat_id,
+        "enabled": True,
+        "channels": [{"id": c, "title": f"c{c}", "link": "https://t.me/x"} for c in channel_ids],
+    }
+    members = set()
+    for user_id in range(messages):
+        joined = list(channel_ids)
+        if random.random() < missing_ratio:
+            joined.remove(random.choice(joined))
+        members.update((user_id, c) for c in joined)
+    fsub.app = FakeClient(latency=latency, members=members)
+
+    samples = []
+    for user_id in range(messages):
+        start = time.perf_counter()
+        await fsub.enforce_fsub(chat_id, user_id, user_id, "Bench")
+        samples.append(time.perf_counter() - start)
+    report(f"enforce_fsub ({channels} channels, {latency * 1000:.0f}ms RPC, {missing_ratio:.0%} missing one)", samples)
+
+def configure_chats(chats, channels):
+    fsub.state_ready.set()
+    chat_ids = [-1001000000000 - i for i in range(chats)]
+    channel_ids = [-1002000000000 - i for i in range(channels)]
+    for chat_id in chat_ids:
+        fsub.forcesub_cache[chat_id] = {
+            "chat_id": chat_id,
+            "enabled": True,
+            "channels": [{"id": c, "title": f"c{c}", "link": "https://t.me/x"} for c in channel_ids],
+        }
+    return chat_ids
+
+# Runs inside each shard process in place of fsub.run_shard, with the fake client
+def bench_shard(index, pipe, results, chats, channels, latency, workers, cpu):
+    asyncio.run(run_bench_shard(index, pipe, results, chats, channels, latency, workers, cpu))
+
+async def run_bench_shard(index, pipe, results, chats, channels, latency, workers, cpu):
+    fsub.app = FakeClient(latency=latency, jitter=0, cpu=cpu)
+    configure_chats(chats, channels)
+    fsub.enforcement_queue = fsub.EnforcementQueue(workers, fsub.FSUB_QUEUE_SIZE, "block", stride=fsub.SHARD_COUNT)
+    fsub.enforcement_queue.start()
+    results.put(("ready", index))
+    await fsub.consume_shard_pipe(pipe)
+    results.put(("done", fsub.enforcement_queue.processed, fsub.app.rpc_count))
+
+async def replay(queue, chat_ids, messages):
+    start = time.perf_counter()
+    for message_id in range(messages):
+        await queue.submit(random.choice(chat_ids), random.randrange(1_000_000), message_id, "Bench")
+    await queue.stop()
+    return time.perf_counter() - start
+
+# Replays synthetic group messages through the receiver into 1, 2, 4, ... shard
+# processes. The total number of workers stays `workers` in every run, split evenly
+# between the shards, so the numbers show what the extra processes add rather than
+# the extra concurrency; with `cpu` > 0 that is CPU spread over cores.
+async def bench_sharding(messages, max_shards, chats, channels, latency, workers, cpu):
+    chat_ids = configure_chats(chats, channels)
+    fsub.app = FakeClient(latency=latency, jitter=0, cpu=cpu)
+    local = fsub.EnforcementQueue(workers, fsub.FSUB_QUEUE_SIZE, "block")
+    local.start()
+    elapsed = await replay(local, chat_ids, messages)
+    for worker in local.workers:
+        worker.cancel()
+    print(f"in-process, {workers} workers: {messages / elapsed:.0f} msgs/s ({fsub.app.rpc_count / messages:.1f} RPCs/msg)")
+
+    shards = 1
+    while shards <= max_shards:
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        target = partial(
+            bench_shard, results=results, chats=chats, channels=channels, latency=latency,
+            workers=max(1, workers // shards), cpu=cpu,
+        )
+        queue = fsub.ShardedEnforcementQueue(shards, fsub.FSUB_QUEUE_SIZE, "block", target=target)
+        queue.start()
+        loop = asyncio.get_running_loop()
+        for _ in range(shards):
+            await loop.run_in_executor(None, results.get)  # shard processes are up
+        elapsed = await replay(queue, chat_ids, messages)
+        done = [await loop.run_in_executor(None, results.get) for _ in range(shards)]
+        checked = sum(d[1] for d in done)
+        rpcs = sum(d[2] for d in done)
+        print(f"{shards} shard(s) x {max(1, workers // shards)} workers: {messages / elapsed:.0f} msgs/s ({checked} checked, {rpcs / max(checked, 1):.1f} RPCs/msg)")
+        shards *= 2
+
+# Scenarios: the real update handlers against the fake client and the in-memory DB
+ENFORCE_FSUB = fsub.enforce_fsub
+
+class Scenario:
+    def __init__(self, args, members=None):
+        fsub.app = FakeClient(latency=args.latency, members=members, flood_rate=args.flood_rate)
+        self.db = install_fake_db()
+        self.db_latency = args.db_latency
+        self.db_error_rate = args.db_error_rate
+        fsub.membership_cache = fsub.MembershipCache(600, 60, 100000)
+        for state in (fsub.forcesub_cache, fsub.join_templates, fsub.channel_entities, fsub.warnings, fsub.pending_deletes):
+            state.clear()
+        fsub.channel_index = None
+        fsub.enforcement_queue = fsub.EnforcementQueue(fsub.FSUB_WORKERS, fsub.FSUB_QUEUE_SIZE, "block")
+        fsub.state_ready.set()
+        self.started = {}  # (chat_id, message_id) -> time the update arrived
+        self.samples = []
+
+        async def timed_enforce(chat_id, user_id, message_id, name):
+            try:
+                return await ENFORCE_FSUB(chat_id, user_id, message_id, name)
+            finally:
+                arrived = self.started.pop((chat_id, message_id), None)
+                if arrived is not None:
+                    self.samples.append(time.perf_counter() - arrived)
+        fsub.enforce_fsub = timed_enforce
+
+    async def add_configs(self, chat_ids, channel_ids, mode="strict"):
+        for chat_id in chat_ids:
+            channels = [{"id": c, "title": f"c{c}", "link": "https://t.me/x"} for c in channel_ids]
+            await fsub.save_forcesub(chat_id, {"channels": channels, "enabled": True, "mode": mode})
+
+    # Setup runs against a healthy database; the measured part gets the injected faults
+    def degrade_db(self):
+        self.db["latency"] = self.db_latency
+        self.db["error_rate"] = self.db_error_rate
+
+    async def replay(self, events, rate=None):
+        self.degrade_db()
+        fsub.enforcement_queue.start()
+        rpcs, ops = fsub.app.rpc_count, self.db["db_ops"]
+        start = time.perf_counter()
+        for i, event in enumerate(events):
+            if rate:
+                await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+            self.started[(event.chat_id, event.id)] = time.perf_counter()
+            await fsub.handle_new_message(event)
+            await fsub.check_fsub_handler(event)
+        await fsub.enforcement_queue.stop()
+        elapsed = time.perf_counter() - start
+        # Batched deletes and write-behind tracking are part of the cost of a message
+        await asyncio.sleep(fsub.DELETE_BATCH_DELAY * 2)
+        await fsub.flush_trackers()
+        for worker in fsub.enforcement_queue.workers:
+            worker.cancel()
+        return elapsed, fsub.app.rpc_count - rpcs, self.db["db_ops"] - ops
+
+    def report(self, name, count, elapsed, rpcs, db_ops):
+        line = f"{name}: {count / elapsed:.0f} msgs/s, {rpcs / count:.2f} RPCs/msg, {db_ops / count:.3f} DB ops/msg"
+        if self.samples:
+            line += f", p50={percentile(self.samples, 50) * 1000:.1f}ms p99={percentile(self.samples, 99) * 1000:.1f}ms"
+        if fsub.app.flood_waits:
+            line += f", {fsub.app.flood_waits} flood waits"
+        if self.db["db_errors"]:
+            line += f", {self.db['db_errors']} DB errors"
+        print(line)
+
+def group_events(chat_ids, users, messages):
+    return [FakeEvent(random.choice(chat_ids), random.choice(users), message_id=i) for i in range(messages)]
+
+def memberships(users, channel_ids, missing_ratio):
+    return {(u, c) for u in users for c in channel_ids if random.random() >= missing_ratio}
+
+# Regulars chatting in many groups at a steady rate
+async def scenario_steady(args):
+    chat_ids = [-1001000000000 - i for i in range(50)]
+    channel_ids = [-1002000000000 - i for i in range(args.channels)]
+    users = list(range(1, 2001))
+    scenario = Scenario(args, memberships(users, channel_ids, args.missing / args.channels))
+    await scenario.add_configs(chat_ids, channel_ids, args.mode)
+    elapsed, rpcs, ops = await scenario.replay(group_events(chat_ids, users, args.messages), rate=args.rate)
+    scenario.report(f"steady ({args.rate:.0f} msg/s offered, {args.mode})", args.messages, elapsed, rpcs, ops)
+
+# A burst of fresh accounts, none of them joined, flooding one group at once
+async def scenario_raid(args):
+    chat_ids = [-1001000000000]
+    channel_ids = [-1002000000000 - i for i in range(args.channels)]
+    scenario = Scenario(args, members=set())
+    await scenario.add_configs(chat_ids, channel_ids)
+    raiders = list(range(100000, 100000 + args.messages // 5))
+    elapsed, rpcs, ops = await scenario.replay(group_events(chat_ids, raiders, args.messages))
+    scenario.report(f"raid ({len(raiders)} accounts)", args.messages, elapsed, rpcs, ops)
+
+# /broadcast to every stored user
+async def scenario_broadcast(args):
+    scenario = Scenario(args)
+    await fsub.users_collection.insert_many([{"user_id": u} for u in range(1, args.recipients + 1)])
+    await fsub.init_totals()
+    fsub.BROADCAST_RATE = args.broadcast_rate
+    fsub.broadcast_clients[:] = [FakeClient(latency=args.latency, flood_rate=args.flood_rate) for _ in range(args.sessions - 1)]
+    for i, client in enumerate(fsub.broadcast_clients):
+        client.helper_id = i + 1
+    doc = {
+        "status": "running", "text": "bench", "from_chat": None, "message_id": None,
+        "progress_chat": 1, "progress_msg": 1, "stage": "groups", "last_id": None,
+        "total": sum(await fsub.get_totals()), "sent_groups": 0, "sent_users": 0, "failed": 0,
+        "pinned": 0, "pruned": 0, "failures": {}, "started_at": None, "owner": fsub.INSTANCE_ID,
+    }
+    doc["_id"] = (await fsub.broadcasts_collection.insert_one(doc)).inserted_id
+    ops = scenario.db["db_ops"]
+    scenario.degrade_db()
+    start = time.perf_counter()
+    await fsub.Broadcast(doc).run()
+    elapsed = time.perf_counter() - start
+    rpcs = fsub.app.rpc_count + sum(client.rpc_count for client in fsub.broadcast_clients)
+    scenario.report(f"broadcast ({args.recipients} users, {args.sessions} sessions)", args.recipients, elapsed, rpcs, scenario.db["db_ops"] - ops)
+    fsub.broadcast_clients.clear()
+
+# Boot with existing data, then the first messages hit cold caches
+async def scenario_cold_start(args):
+    chat_ids = [-1001000000000 - i for i in range(1000)]
+    channel_ids = [-1002000000000 - i for i in range(args.channels)]
+    users = list(range(1, 5001))
+    scenario = Scenario(args, memberships(users, channel_ids, args.missing / args.channels))
+    channels = [{"id": c, "title": f"c{c}", "link": "https://t.me/x"} for c in channel_ids]
+    await fsub.forcesub_collection.insert_many([{"chat_id": c, "channels": channels, "enabled": True} for c in chat_ids])
+    await fsub.users_collection.insert_many([{"user_id": u} for u in users])
+    await fsub.groups_collection.insert_many([{"group_id": c} for c in chat_ids])
+    ops = scenario.db["db_ops"]
+    scenario.degrade_db()
+    fsub.state_ready.clear()
+    start = time.perf_counter()
+    # Messages arrive right away and wait in the queue until configs and bans are loaded
+    replay = asyncio.ensure_future(scenario.replay(group_events(chat_ids, users, args.messages)))
+    await fsub.load_state()
+    boot = time.perf_counter() - start
+    print(f"cold start: ready {boot * 1000:.0f}ms, {scenario.db['db_ops'] - ops} DB ops")
+    elapsed, rpcs, ops = await replay
+    scenario.report("cold start (first messages)", args.messages, elapsed, rpcs, ops)
+
+SCENARIOS = {
+    "steady": scenario_steady,
+    "raid": scenario_raid,
+    "broadcast": scenario_broadcast,
+    "cold-start": scenario_cold_start,
+}
+
+async def run_scenarios(args):
+    names = SCENARIOS if args.scenario == "all" else [args.scenario]
+    for name in names:
+        await SCENARIOS[name](args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Force-sub bot benchmarks against a fake Telegram client")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--missing", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--shards", type=int, default=0, help="replay messages through up to this many shard processes")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=fsub.FSUB_WORKERS, help="total workers in the sharding runs, split between the shards")
+    parser.add_argument("--cpu", type=float, default=0.0, help="CPU seconds per fake RPC in the sharding runs")
+    parser.add_argument("--scenario", choices=["all", *SCENARIOS], help="run a load scenario against the in-memory DB")
+    parser.add_argument("--rate", type=float, default=500, help="messages per second offered in the steady scenario")
+    parser.add_argument("--recipients", type=int, default=2000, help="users the broadcast scenario sends to, at RPC_SEND_RATE per session")
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="messages per second per broadcast session")
+    parser.add_argument("--sessions", type=int, default=1, help="bot sessions sending the broadcast")
+    parser.add_argument("--mode", choices=["strict", "trust"], default="strict", help="force-sub mode of the steady scenario's groups")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="chance of a flood wait per fake RPC")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds added to each in-memory DB call")
+    parser.add_argument("--db-error-rate", type=float, default=0.0, help="chance of an AutoReconnect per in-memory DB call")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if args.scenario:
+        if AsyncMongoMockClient is None:
+            parser.error("scenarios need mongomock-motor (pip install mongomock-motor)")
+        if args.flood_rate or args.db_error_rate:
+            fsub.logger.setLevel(logging.CRITICAL)  # every injected failure would log an error
+        asyncio.run(run_scenarios(args))
+    elif args.shards:
+        asyncio.run(bench_sharding(args.messages, args.shards, args.chats, args.channels, args.latency, args.workers, args.cpu))
+    else:
+        asyncio.run(bench_multi_channel_check(args.messages, args.channels, args.latency, args.missing))
+
+if __name__ == "__main__":
+    main()
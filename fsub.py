@@ -1,11 +1,27 @@
-import os, logging, random, asyncio
-from datetime import datetime
+import os, re, io, logging, random, asyncio, time, weakref, multiprocessing, functools, bisect, contextvars, math, socket
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
-from telethon import TelegramClient, events, Button
+from telethon import TelegramClient, events, Button, utils, types
 from telethon.tl.functions.channels import GetParticipantRequest, GetFullChannelRequest
 from telethon.tl.functions.messages import ExportChatInviteRequest
 from telethon.errors.rpcerrorlist import UserNotParticipantError
-from telethon.errors import ChatAdminRequiredError
+from telethon.errors import (
+    ChatAdminRequiredError, FloodWaitError, UserIsBlockedError, InputUserDeactivatedError,
+    PeerIdInvalidError, ChatIdInvalidError, ChannelInvalidError, ChannelPrivateError, ChatWriteForbiddenError,
+    RPCError,
+)
+from pymongo import UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure, PyMongoError, DuplicateKeyError
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed when REDIS_URL is set
+    aioredis = None
+
+import metrics
 
 # Logging configuration
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -19,50 +35,715 @@ LOGGER_ID = int(os.getenv("LOGGER_ID", "0"))
 API_ID = int(os.getenv("API_ID", "0"))
 API_HASH = os.getenv("API_HASH", None)
 FSUB = os.getenv("FSUB", "").strip()
+MEMBER_CACHE_POSITIVE_TTL = int(os.getenv("MEMBER_CACHE_POSITIVE_TTL", "600"))
+MEMBER_CACHE_NEGATIVE_TTL = int(os.getenv("MEMBER_CACHE_NEGATIVE_TTL", "60"))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "100000"))
+FSUB_POLL_INTERVAL = int(os.getenv("FSUB_POLL_INTERVAL", "30"))
+FSUB_CHECK_CONCURRENCY = int(os.getenv("FSUB_CHECK_CONCURRENCY", "4"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "5"))
+BROADCAST_CHECKPOINT_INTERVAL = int(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "5"))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "60"))
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv("BROADCAST_PROGRESS_INTERVAL", "15"))
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", "43200"))
+ENTITY_REFRESH_INTERVAL = int(os.getenv("ENTITY_REFRESH_INTERVAL", "3600"))
+WARNING_WINDOW = int(os.getenv("WARNING_WINDOW", "60"))
+DELETE_BATCH_DELAY = float(os.getenv("DELETE_BATCH_DELAY", "0.5"))
+FSUB_WORKERS = int(os.getenv("FSUB_WORKERS", "16"))
+FSUB_QUEUE_SIZE = int(os.getenv("FSUB_QUEUE_SIZE", "2000"))
+FSUB_OVERFLOW_POLICY = os.getenv("FSUB_OVERFLOW_POLICY", "block").strip().lower()
+FSUB_MAX_BLOCKED = int(os.getenv("FSUB_MAX_BLOCKED", os.getenv("FSUB_QUEUE_SIZE", "2000")))
+PRUNE_BATCH_SIZE = int(os.getenv("PRUNE_BATCH_SIZE", "500"))
+TRACK_FLUSH_INTERVAL = float(os.getenv("TRACK_FLUSH_INTERVAL", "5"))
+TRACK_KNOWN_SIZE = int(os.getenv("TRACK_KNOWN_SIZE", "500000"))
+SHARDS = int(os.getenv("SHARDS", "0"))
+SHARD_BATCH_SIZE = int(os.getenv("SHARD_BATCH_SIZE", "100"))
+SHARD_PUT_TIMEOUT = float(os.getenv("SHARD_PUT_TIMEOUT", "30"))
+SHARD_MAX_RESTARTS = int(os.getenv("SHARD_MAX_RESTARTS", "5"))
+REDIS_URL = os.getenv("REDIS_URL", None)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+WARM_ENTITY_LIMIT = int(os.getenv("WARM_ENTITY_LIMIT", "200"))
+WARM_RATE = float(os.getenv("WARM_RATE", "5"))
+TRUST_WINDOW = int(os.getenv("TRUST_WINDOW", "3600"))
+TRUST_RECHECK_RATE = float(os.getenv("TRUST_RECHECK_RATE", "0.05"))
+TRUST_MAX_USERS = int(os.getenv("TRUST_MAX_USERS", "200000"))
+BROADCAST_TOKENS = os.getenv("BROADCAST_TOKENS", "").split()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "500"))
+LOG_BATCH_SIZE = min(10, int(os.getenv("LOG_BATCH_SIZE", "10")))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "5"))
+RPC_RATE = float(os.getenv("RPC_RATE", "0"))
+RPC_SEND_RATE = float(os.getenv("RPC_SEND_RATE", "30"))
+RPC_MAX_WAIT = int(os.getenv("RPC_MAX_WAIT", "10"))
+RPC_MAX_RETRIES = int(os.getenv("RPC_MAX_RETRIES", "3"))
+FSUB_STATS_RETENTION = int(os.getenv("FSUB_STATS_RETENTION", "90"))
+# Set by the receiver for the shard processes it starts, never by hand
+SHARD_INDEX = int(os.environ["FSUB_SHARD_INDEX"]) if os.getenv("FSUB_SHARD_INDEX") else None
+SHARD_COUNT = int(os.getenv("FSUB_SHARD_COUNT", "1"))
+
+# Metrics, served in Prometheus format on METRICS_PORT and summarised by /perf
+STARTED_AT = time.monotonic()
+HANDLER_SECONDS = metrics.Histogram("fsub_handler_seconds", "Update handler latency by handler")
+RPC_SECONDS = metrics.Histogram("fsub_rpc_seconds", "Telegram request latency by request type")
+RPC_ERRORS = metrics.Counter("fsub_rpc_errors_total", "Failed Telegram requests by request type and error")
+FLOOD_WAIT_SECONDS = metrics.Counter("fsub_flood_wait_seconds_total", "Flood wait seconds imposed by Telegram by request type")
+MONGO_SECONDS = metrics.Histogram("fsub_mongo_seconds", "MongoDB command latency by command")
+MESSAGES_DELETED = metrics.Counter("fsub_messages_deleted_total", "Messages deleted by kind: non-member messages and the bot's own join prompts")
+BROADCAST_MESSAGES = metrics.Counter("fsub_broadcast_messages_total", "Broadcast deliveries by result")
+
+# Seconds from process start to the first handled update and to warm caches
+FIRST_HANDLED = None
+WARMED = None
+metrics.Gauge("fsub_startup_first_update_seconds", "Seconds from start to the first handled update", lambda: FIRST_HANDLED or 0)
+metrics.Gauge("fsub_startup_warm_seconds", "Seconds from start until caches were warm", lambda: WARMED or 0)
+
+def timed_handler(func):
+    @functools.wraps(func)
+    async def wrapper(event):
+        global FIRST_HANDLED
+        rpc_priority.set(PRIORITY_NORMAL)  # each update is handled in its own task
+        try:
+            with HANDLER_SECONDS.time(handler=func.__name__):
+                return await func(event)
+        finally:
+            if FIRST_HANDLED is None:
+                FIRST_HANDLED = time.monotonic() - STARTED_AT
+                logger.info(f"First update handled {FIRST_HANDLED:.2f}s after start")
+    return wrapper
+
+# Token bucket with adaptive backoff: a flood wait pauses every caller and halves
+# the rate, which then creeps back up to the configured maximum on success.
+# delay() and take() let a scheduler check a bucket without waiting on it.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate / 4)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def delay(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    async def acquire(self):
+        async with self._lock:
+            while (wait := self.delay()) > 0:
+                await asyncio.sleep(wait)
+            self.take()
+
+    def flood_wait(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.rate = max(self.max_rate / 10, self.rate / 2)
+        self.tokens = 0
+
+    def success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
 
-# Telegram client
-app = TelegramClient('bot', api_id=API_ID, api_hash=API_HASH)
+# Request priority, set per task: enforcement outranks commands (every update
+# handler), which outrank broadcasts, logging and warm-up. Tasks inherit the priority
+# of their creator. Requests made outside all of these, such as logging in and
+# Telethon's own update fetching, have none: they queue as normal but sit out flood
+# waits up to Telethon's flood_sleep_threshold, as they did before the gateway.
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low", None: "none"}
+rpc_priority = contextvars.ContextVar("rpc_priority", default=None)
+# Off while a caller retries flood waits itself, so they are not waited out twice over
+rpc_retry = contextvars.ContextVar("rpc_retry", default=True)
+
+# Requests that count against the bot's shared message-sending limit
+SEND_METHODS = {"SendMessageRequest", "ForwardMessagesRequest", "SendMediaRequest", "SendMultiMediaRequest"}
+
+def method_group(method):
+    return "send" if method in SEND_METHODS else method
+
+RPC_QUEUED = metrics.Histogram("fsub_rpc_queue_seconds", "Time Telegram requests waited for the scheduler by priority")
+
+# Schedules every request of one client: a global bucket plus a bucket for sending,
+# and a flood wait on any method pauses that method for all callers. When requests
+# have to wait they are released highest priority first, oldest first within one.
+# Only low-priority requests sit out a pause longer than RPC_MAX_WAIT (or than
+# sleep_threshold for requests without a priority); the others fail at once with a
+# FloodWaitError for the time left, as if Telegram had sent it.
+class RpcGateway:
+    def __init__(self, rate, send_rate, sleep_threshold=60):
+        self.sleep_threshold = sleep_threshold
+        self.bucket = TokenBucket(rate) if rate else None
+        self.method_buckets = {"send": TokenBucket(send_rate)} if send_rate else {}
+        self.paused_until = {}  # method group without a bucket -> monotonic time
+        self.waiters = []  # sorted (priority, seq, group, future)
+        self.seq = 0
+        self.wake = None
+        self.dispatcher = None
+
+    def delay(self, group):
+        delays = [self.paused_until.get(group, 0) - time.monotonic()]
+        if self.bucket:
+            delays.append(self.bucket.delay())
+        if group in self.method_buckets:
+            delays.append(self.method_buckets[group].delay())
+        return max(delays)
+
+    def take(self, group):
+        if self.bucket:
+            self.bucket.take()
+        if group in self.method_buckets:
+            self.method_buckets[group].take()
+
+    # Longest flood wait a request of this priority sits out, None for no limit
+    def max_wait(self, priority):
+        if priority is None:
+            return self.sleep_threshold
+        return None if priority == PRIORITY_LOW else RPC_MAX_WAIT
+
+    async def acquire(self, priority, group):
+        delay = self.delay(group)
+        limit = self.max_wait(priority)
+        if limit is not None and delay > limit:
+            raise FloodWaitError(request=None, capture=math.ceil(delay))
+        if not self.waiters and delay <= 0:
+            self.take(group)
+            return
+        if self.dispatcher is None:
+            self.wake = asyncio.Event()
+            self.dispatcher = spawn(self.dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        entry = (PRIORITY_NORMAL if priority is None else priority, self.seq, group, future, limit)
+        bisect.insort(self.waiters, entry)
+        self.wake.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            raise
+
+    async def dispatch(self):
+        while True:
+            self.wake.clear()
+            wait = None
+            for entry in list(self.waiters):
+                group, future, limit = entry[2], entry[3], entry[4]
+                if future.done():
+                    self.waiters.remove(entry)
+                    continue
+                delay = self.delay(group)
+                if limit is not None and delay > limit:
+                    self.waiters.remove(entry)
+                    future.set_exception(FloodWaitError(request=None, capture=math.ceil(delay)))
+                    continue
+                if delay <= 0:
+                    self.waiters.remove(entry)
+                    self.take(group)
+                    future.set_result(None)
+                    wait = 0
+                    break
+                wait = delay if wait is None else min(wait, delay)
+            if wait == 0:
+                await asyncio.sleep(0)  # let the released request run first
+            elif wait is None:
+                await self.wake.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def flood_wait(self, group, seconds):
+        if group in self.method_buckets:
+            self.method_buckets[group].flood_wait(seconds)
+        else:
+            self.paused_until[group] = max(self.paused_until.get(group, 0), time.monotonic() + seconds)
+
+    def success(self, group):
+        if group in self.method_buckets:
+            self.method_buckets[group].success()
+
+    def depth(self, priority=None):
+        return sum(1 for entry in self.waiters if priority is None or entry[0] == priority)
+
+    # Makes one request, send() being the coroutine function that talks to Telegram
+    async def call(self, method, send):
+        group = method_group(method)
+        priority = rpc_priority.get()
+        retries = RPC_MAX_RETRIES if rpc_retry.get() else 0
+        for attempt in range(retries + 1):
+            queued_at = time.perf_counter()
+            try:
+                await self.acquire(priority, group)
+            except FloodWaitError:
+                RPC_ERRORS.inc(method=method, error="PausedByFloodWait")
+                raise
+            start = time.perf_counter()
+            RPC_QUEUED.observe(start - queued_at, priority=PRIORITY_NAMES[priority])
+            try:
+                result = await send()
+            except FloodWaitError as e:
+                FLOOD_WAIT_SECONDS.inc(e.seconds, method=method)
+                RPC_ERRORS.inc(method=method, error=type(e).__name__)
+                self.flood_wait(group, e.seconds)
+                limit = self.max_wait(priority)
+                if attempt < retries and (limit is None or e.seconds <= limit):
+                    logger.warning(f"Flood wait of {e.seconds}s on {method}, retrying when it ends")
+                    continue
+                raise
+            except Exception as e:
+                RPC_ERRORS.inc(method=method, error=type(e).__name__)
+                raise
+            finally:
+                RPC_SECONDS.observe(time.perf_counter() - start, method=method)
+            self.success(group)
+            return result
+
+# Every request made through the client, including those behind send_message,
+# delete_messages and friends, passes through __call__ and the client's gateway.
+# Telethon's own flood sleep is turned off so flood waits reach the gateway; the
+# request is then retried once the pause is over, unless the wait is longer than
+# its priority allows (see RpcGateway.max_wait).
+class InstrumentedClient(TelegramClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gateway = RpcGateway(RPC_RATE, RPC_SEND_RATE, sleep_threshold=self.flood_sleep_threshold)
+        self.flood_sleep_threshold = 0
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        method = type(request[0] if isinstance(request, list) and request else request).__name__
+        send = functools.partial(super().__call__, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+        return await self.gateway.call(method, send)
+
+class MongoMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+
+# Telegram client; a shard process has its own session and only makes requests,
+# updates are received by the main process alone
+if SHARD_INDEX is None:
+    app = InstrumentedClient('bot', api_id=API_ID, api_hash=API_HASH)
+else:
+    app = InstrumentedClient(f'bot-shard{SHARD_INDEX}', api_id=API_ID, api_hash=API_HASH, receive_updates=False)
+metrics.Gauge("fsub_rpc_queue_depth", "Telegram requests waiting for the scheduler", lambda: app.gateway.depth())
 
 # MongoDB connection
-mongo_client = AsyncIOMotorClient(MONGO_URI)
+mongo_client = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoMetrics()])
 db = mongo_client.fsub
 users_collection = db["users"]
 groups_collection = db["groups"]
 forcesub_collection = db["forcesubs"]
 banned_users_collection = db["banned_users"]
+broadcasts_collection = db["broadcasts"]
+# Names this process as the owner of the broadcast it runs; replicas share the database
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+stats_collection = db["stats"]
+enforcement_stats_collection = db["enforcement_stats"]
+
+# Long-lived background tasks; references are kept so they are not garbage collected
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # Database functions
-async def add_user(user_id):
-    if not await users_collection.find_one({"user_id": user_id}):
-        await users_collection.insert_one({"user_id": user_id})
+# Users who blocked the bot and groups that removed it are kept with inactive=True;
+# seeing them again (a new message) makes them active again.
+ACTIVE = {"inactive": {"$ne": True}}
+
+UNIQUE_INDEXES = (
+    (users_collection, "user_id"),
+    (groups_collection, "group_id"),
+    (forcesub_collection, "chat_id"),
+    (banned_users_collection, "user_id"),
+)
+
+async def remove_duplicates(collection, field):
+    pipeline = [
+        {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    removed = 0
+    async for dup in collection.aggregate(pipeline):
+        result = await collection.delete_many({"_id": {"$in": dup["ids"][1:]}})
+        removed += result.deleted_count
+    logger.warning(f"Removed {removed} duplicate {collection.name} documents by {field}")
+
+async def ensure_indexes():
+    for collection, field in UNIQUE_INDEXES:
+        try:
+            await collection.create_index(field, unique=True)
+        except DuplicateKeyError:
+            # Older deployments could insert the same id twice; keep the first copy
+            await remove_duplicates(collection, field)
+            await collection.create_index(field, unique=True)
+    await enforcement_stats_collection.create_index([("chat_id", 1), ("hour", 1)])
+    if FSUB_STATS_RETENTION:
+        try:
+            await enforcement_stats_collection.create_index("hour", expireAfterSeconds=FSUB_STATS_RETENTION * 86400)
+        except OperationFailure as e:
+            # An index made with another retention has to be dropped by hand first
+            logger.warning(f"Could not set enforcement stats retention: {e}")
+
+# Write-behind tracking of users/groups seen in messages: ids are buffered in memory
+# and upserted in one bulk_write per flush, ids already written are skipped
+class SeenTracker:
+    def __init__(self, collection, field, counter):
+        self.collection = collection
+        self.field = field
+        self.counter = counter
+        self.known = set()
+        self.pending = set()
+        self.unbumped = 0  # total delta whose $inc failed, added on the next flush
+
+    def add(self, item_id):
+        if item_id not in self.known:
+            self.pending.add(item_id)
+
+    def forget(self, item_id):
+        self.known.discard(item_id)
+        self.pending.discard(item_id)
+
+    async def flush(self):
+        if self.pending:
+            await self.write()
+        if self.unbumped:
+            delta, self.unbumped = self.unbumped, 0
+            try:
+                await bump_total(self.counter, delta)
+            except PyMongoError as e:
+                logger.error(f"Error updating the {self.counter} total: {e}")
+                self.unbumped += delta
+
+    async def write(self):
+        ids, self.pending = self.pending, set()
+        ops = [
+            UpdateOne({self.field: item_id}, {"$unset": {"inactive": "", "inactive_reason": ""}}, upsert=True)
+            for item_id in ids
+        ]
+        try:
+            result = await self.collection.bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            logger.error(f"Error flushing {len(ids)} {self.collection.name}: {e}")
+            self.pending |= ids
+            return
+        # New documents plus inactive ones that came back
+        self.unbumped += result.upserted_count + result.modified_count
+        if len(self.known) + len(ids) > TRACK_KNOWN_SIZE:
+            self.known.clear()  # re-upserting a known id is harmless, just one more op
+        self.known |= ids
+
+user_tracker = SeenTracker(users_collection, "user_id", "users")
+group_tracker = SeenTracker(groups_collection, "group_id", "groups")
+
+# Stats are kept as counters so /stats never scans a collection:
+# {"_id": "totals", "users": n, "groups": n} counts active records, and
+# {"_id": "daily:<date>", "active_users": n, "active_groups": n} counts distinct
+# users/groups seen that day (per process, so replicas may count a user twice)
+# Until init_totals has run, deltas wait in pending_totals; an $inc upsert made
+# earlier would create the totals document without the seed count
+pending_totals = {}
+totals_ready = False
+
+async def bump_total(counter, delta):
+    if not delta:
+        return
+    if not totals_ready:
+        pending_totals[counter] = pending_totals.get(counter, 0) + delta
+        return
+    await stats_collection.update_one({"_id": "totals"}, {"$inc": {counter: delta}}, upsert=True)
+
+async def init_totals():
+    global totals_ready
+    if not await stats_collection.find_one({"_id": "totals"}):
+        # First start with counters: seed them with one full count. It includes the
+        # changes made until it was read, so only later deltas are kept.
+        users = await users_collection.count_documents(ACTIVE)
+        groups = await groups_collection.count_documents(ACTIVE)
+        pending_totals.clear()
+        await stats_collection.update_one(
+            {"_id": "totals"}, {"$setOnInsert": {"users": users, "groups": groups}}, upsert=True
+        )
+    deltas = {counter: delta for counter, delta in pending_totals.items() if delta}
+    pending_totals.clear()
+    totals_ready = True
+    if deltas:
+        try:
+            await stats_collection.update_one({"_id": "totals"}, {"$inc": deltas}, upsert=True)
+        except PyMongoError:
+            # Held again for the retry of init_totals
+            totals_ready = False
+            for counter, delta in deltas.items():
+                pending_totals[counter] = pending_totals.get(counter, 0) + delta
+            raise
+
+async def get_totals():
+    totals = await stats_collection.find_one({"_id": "totals"}) or {}
+    return totals.get("users", 0), totals.get("groups", 0)
+
+def today():
+    return datetime.utcnow().strftime("%Y-%m-%d")
+
+class DailyActivity:
+    def __init__(self):
+        self.day = None
+        self.seen = {"users": set(), "groups": set()}
+        self.unflushed = {}  # (day, kind) -> newly seen count
+
+    def record(self, kind, item_id):
+        day = today()
+        if day != self.day:
+            self.day = day
+            self.seen = {"users": set(), "groups": set()}
+        if item_id not in self.seen[kind]:
+            self.seen[kind].add(item_id)
+            self.unflushed[(day, kind)] = self.unflushed.get((day, kind), 0) + 1
+
+    async def flush(self):
+        if not self.unflushed:
+            return
+        counts, self.unflushed = self.unflushed, {}
+        ops = [
+            UpdateOne({"_id": f"daily:{day}"}, {"$inc": {f"active_{kind}": count}, "$set": {"date": day}}, upsert=True)
+            for (day, kind), count in counts.items()
+        ]
+        try:
+            await stats_collection.bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            logger.error(f"Error flushing daily activity: {e}")
+            for key, count in counts.items():
+                self.unflushed[key] = self.unflushed.get(key, 0) + count
+
+daily_activity = DailyActivity()
+
+async def get_daily_activity(day):
+    doc = await stats_collection.find_one({"_id": f"daily:{day}"}) or {}
+    return doc.get("active_users", 0), doc.get("active_groups", 0)
+
+# Per-group enforcement counters for /fsubstats, one document per group and hour:
+# {"_id": "<chat_id>:<hour>", "chat_id": id, "hour": datetime, "checked": n, ...}.
+# Events only bump an in-memory count; each flush is one $inc upsert per group and
+# hour that saw traffic, so database writes don't grow with the number of messages.
+ENFORCEMENT_COUNTERS = ("checked", "deleted", "warned", "confirmed")
+
+class EnforcementStats:
+    def __init__(self, collection):
+        self.collection = collection
+        self.unflushed = {}  # (chat_id, hour) -> {counter: count}
+
+    def record(self, chat_id, counter, count=1):
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        counts = self.unflushed.setdefault((chat_id, hour), {})
+        counts[counter] = counts.get(counter, 0) + count
+
+    async def flush(self):
+        if not self.unflushed:
+            return
+        buckets, self.unflushed = self.unflushed, {}
+        ops = [
+            UpdateOne(
+                {"_id": f"{chat_id}:{hour:%Y-%m-%dT%H}"},
+                {"$inc": counts, "$set": {"chat_id": chat_id, "hour": hour}},
+                upsert=True,
+            )
+            for (chat_id, hour), counts in buckets.items()
+        ]
+        try:
+            await self.collection.bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            logger.error(f"Error flushing enforcement stats for {len(buckets)} groups: {e}")
+            for key, counts in buckets.items():
+                pending = self.unflushed.setdefault(key, {})
+                for counter, count in counts.items():
+                    pending[counter] = pending.get(counter, 0) + count
 
-async def add_group(group_id):
-    if not await groups_collection.find_one({"group_id": group_id}):
-        await groups_collection.insert_one({"group_id": group_id})
+    # Totals per counter over the last hours, from the stored hourly documents
+    async def totals(self, chat_id, hours):
+        since = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+        totals = dict.fromkeys(ENFORCEMENT_COUNTERS, 0)
+        async for doc in self.collection.find({"chat_id": chat_id, "hour": {"$gte": since}}):
+            for counter in ENFORCEMENT_COUNTERS:
+                totals[counter] += doc.get(counter, 0)
+        return totals
+
+enforcement_stats = EnforcementStats(enforcement_stats_collection)
+
+async def flush_trackers():
+    await user_tracker.flush()
+    await group_tracker.flush()
+    await daily_activity.flush()
+    await enforcement_stats.flush()
+
+async def flush_trackers_periodically():
+    while True:
+        await asyncio.sleep(TRACK_FLUSH_INTERVAL)
+        # One failed flush must not end the loop; what wasn't written is retried next time
+        try:
+            await flush_trackers()
+        except Exception as e:
+            logger.error(f"Error flushing trackers: {e}")
+
+def add_user(user_id):
+    user_tracker.add(user_id)
+    daily_activity.record("users", user_id)
+
+def add_group(group_id):
+    group_tracker.add(group_id)
+    daily_activity.record("groups", group_id)
 
 async def remove_group(group_id):
-    if await groups_collection.find_one({"group_id": group_id}):
-        await groups_collection.delete_one({"group_id": group_id})
+    group_tracker.forget(group_id)
+    group = await groups_collection.find_one_and_delete({"group_id": group_id})
+    if group and not group.get("inactive"):
+        await bump_total("groups", -1)
+
+# Banned users, loaded once at startup and kept current by /ban and /unban
+banned_user_ids = set()
+
+def is_banned(user_id):
+    return user_id in banned_user_ids
+
+async def load_banned_users():
+    ids = set()
+    async for doc in banned_users_collection.find({}, {"user_id": 1}):
+        ids.add(doc["user_id"])
+    banned_user_ids.clear()
+    banned_user_ids.update(ids)
+    logger.info(f"Loaded {len(banned_user_ids)} banned users into memory")
+
+# Force-sub config cache: chat_id -> forcesubs document, kept in sync with Mongo
+forcesub_cache = {}
+
+def get_forcesub(chat_id):
+    return forcesub_cache.get(chat_id)
+
+# Join prompt for a non-member; the buttons are prebuilt per chat whenever its config changes
+JOIN_PROMPT = (
+    "👋 **ʜᴇʟʟᴏ** {mention},\n\n"
+    "**🚀 ғᴏʀᴄᴇ ᴀᴄᴄᴇss ᴜɴʟᴏᴄᴋ!**\n__🔐 ʏᴏᴜʀ ᴄʜᴀᴛ ɪs **ʀᴇsᴛʀɪᴄᴛᴇᴅ__**\n__👉 **Jᴏɪɴ ɴᴏᴡ** ᴛᴏ ᴄᴏɴᴛɪɴᴜᴇ ᴄʜᴀᴛᴛɪɴɢ!__**\n\n👇 ᴄʟɪᴄᴋ ʙᴇʟᴏᴡ ᴛᴏ Jᴏɪɴ 👇**:"
+)
+join_templates = {}  # chat_id -> button rows
+
+def build_join_buttons(chat_id, channels):
+    buttons = [Button.url("๏ ᴊᴏɪɴ ๏", c["link"]) for c in channels if c.get("link") and c.get("title")]
+    # Two join buttons per row, then the confirm button
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([Button.inline("ᴄᴏɴғɪʀᴍ ᴊᴏɪɴ", data=f"confirm_join_{chat_id}")])
+    return rows
 
-async def get_all_users():
-    users = []
-    cursor = users_collection.find()
-    async for user in cursor:
+def refresh_join_template(chat_id):
+    doc = forcesub_cache.get(chat_id)
+    if doc and doc.get("channels"):
+        join_templates[chat_id] = build_join_buttons(chat_id, doc["channels"])
+    else:
+        join_templates.pop(chat_id, None)
+
+def get_join_buttons(chat_id):
+    if chat_id not in join_templates:
+        refresh_join_template(chat_id)
+    return join_templates.get(chat_id)
+
+# Everything derived from a chat's config is refreshed here when the config changes
+def config_changed(chat_id):
+    global channel_index
+    refresh_join_template(chat_id)
+    channel_index = None
+
+async def load_forcesub_cache():
+    docs = {}
+    async for doc in forcesub_collection.find():
+        docs[doc["chat_id"]] = doc
+    forcesub_cache.clear()
+    forcesub_cache.update(docs)
+    join_templates.clear()
+    for chat_id in forcesub_cache:
+        config_changed(chat_id)
+    logger.info(f"Loaded {len(forcesub_cache)} force-sub configs into memory")
+
+async def save_forcesub(chat_id, fields, upsert=True):
+    await forcesub_collection.update_one({"chat_id": chat_id}, {"$set": fields}, upsert=upsert)
+    doc = forcesub_cache.get(chat_id)
+    if doc is None:
+        if not upsert:
+            return
+        doc = forcesub_cache[chat_id] = {"chat_id": chat_id}
+    doc.update(fields)
+    config_changed(chat_id)
+
+async def delete_forcesub(chat_id):
+    await forcesub_collection.delete_one({"chat_id": chat_id})
+    forcesub_cache.pop(chat_id, None)
+    config_changed(chat_id)
+
+def apply_forcesub_change(change):
+    op = change["operationType"]
+    if op in ("insert", "update", "replace"):
+        doc = change.get("fullDocument")
+        if doc is not None:
+            forcesub_cache[doc["chat_id"]] = doc
+            config_changed(doc["chat_id"])
+    elif op == "delete":
+        doc_id = change["documentKey"]["_id"]
+        for chat_id, doc in list(forcesub_cache.items()):
+            if doc.get("_id") == doc_id:
+                del forcesub_cache[chat_id]
+                config_changed(chat_id)
+                break
+
+# Keeps forcesub_cache in sync with writes made by other bot replicas.
+# Change streams need a replica set; a standalone mongod falls back to polling.
+async def watch_forcesub_changes():
+    while True:
+        try:
+            async with forcesub_collection.watch(full_document="updateLookup") as stream:
+                # Anything written while the stream was down is picked up by a fresh load
+                await load_forcesub_cache()
+                async for change in stream:
+                    apply_forcesub_change(change)
+        except OperationFailure as e:
+            logger.warning(f"Change streams unavailable ({e}), polling force-sub configs every {FSUB_POLL_INTERVAL}s")
+            break
+        except PyMongoError as e:
+            logger.error(f"Force-sub change stream interrupted: {e}")
+            await asyncio.sleep(5)
+    while True:
+        await asyncio.sleep(FSUB_POLL_INTERVAL)
         try:
-            users.append(user["user_id"])
-        except Exception:
-            pass
-    return users
-
-async def get_all_groups():
-    groups = []
-    cursor = groups_collection.find()
-    async for chat in cursor:
+            await load_forcesub_cache()
+        except PyMongoError as e:
+            logger.error(f"Error polling force-sub configs: {e}")
+
+# Updates are accepted as soon as the client is connected. Handlers that need the
+# force-sub configs or the banned set wait for state_ready, which is set once both
+# are loaded; everything else is warmed afterwards in the background.
+state_ready = asyncio.Event()
+
+async def load_state():
+    while True:
         try:
-            groups.append(chat["group_id"])
-        except Exception:
-            pass
-    return groups
+            await asyncio.gather(load_banned_users(), load_forcesub_cache())
+            break
+        except PyMongoError as e:
+            logger.error(f"Error loading force-sub configs and bans, retrying: {e}")
+            await asyncio.sleep(5)
+    state_ready.set()
 
 D = ["😘", "👾", "🤝", "👀", "❤️‍🔥", "💘", "😍", "😇", "🕊️", "🐳", "🎉", "🏆", "🗿", "⚡", "💯", "👌", "🍾"]
 
@@ -78,48 +759,353 @@ if FSUB:
     except Exception as e:
         logger.error("Invalid FSUB format. Should be space-separated channel IDs or usernames.")
 
+# Membership cache shared by every force-sub check, keyed by (user_id, channel)
+def channel_key(channel):
+    if isinstance(channel, int):
+        return utils.resolve_id(channel)[0]
+    return str(channel).lstrip("@").lower()
+
+class MembershipCache:
+    def __init__(self, positive_ttl, negative_ttl, max_size):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (user_id, channel_key) -> (is_member, expires_at)
+        self._by_user = {}  # user_id -> set of cached channel keys
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, channel):
+        key = (user_id, channel_key(channel))
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._discard(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return is_member
+
+    def set(self, user_id, channel, is_member):
+        key = (user_id, channel_key(channel))
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        self._by_user.setdefault(user_id, set()).add(key[1])
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+
+    def invalidate_negative(self, user_id):
+        for ckey in list(self._by_user.get(user_id, ())):
+            entry = self._entries.get((user_id, ckey))
+            if entry is not None and not entry[0]:
+                self._discard((user_id, ckey))
+
+    def _discard(self, key):
+        self._entries.pop(key, None)
+        user_keys = self._by_user.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key[1])
+            if not user_keys:
+                del self._by_user[key[0]]
+
+membership_cache = MembershipCache(MEMBER_CACHE_POSITIVE_TTL, MEMBER_CACHE_NEGATIVE_TTL, MEMBER_CACHE_SIZE)
+
+# "Is a member" answers shared between shard processes through Redis, looked up only
+# when the local cache misses. "Not a member" stays local: it is short-lived and a
+# shared copy would keep blocking a user who just joined.
+class SharedMembership:
+    def __init__(self, url, ttl):
+        self.redis = aioredis.from_url(url)
+        self.ttl = ttl
+
+    def key(self, user_id, channel):
+        return f"fsub:member:{user_id}:{channel_key(channel)}"
+
+    async def is_member(self, user_id, channel):
+        try:
+            return await self.redis.exists(self.key(user_id, channel)) > 0
+        except Exception as e:
+            logger.warning(f"Shared membership lookup failed: {e}")
+            return False
+
+    async def set(self, user_id, channel, is_member):
+        try:
+            if is_member:
+                await self.redis.set(self.key(user_id, channel), 1, ex=max(1, self.ttl))
+            else:
+                await self.redis.delete(self.key(user_id, channel))
+        except Exception as e:
+            logger.warning(f"Shared membership update failed: {e}")
+
+shared_membership = None
+if REDIS_URL:
+    if aioredis is None:
+        logger.warning("REDIS_URL is set but the redis package is not installed, membership cache stays local")
+    else:
+        shared_membership = SharedMembership(REDIS_URL, MEMBER_CACHE_POSITIVE_TTL)
+
+# Concurrent identical lookups share one pending call instead of each hitting Telegram
+class SingleFlight:
+    def __init__(self):
+        self._pending = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        self.calls += 1
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._pending[key] = future
+            future.add_done_callback(lambda f: self._finish(key, f))
+        else:
+            self.coalesced += 1
+        # A cancelled waiter (e.g. an early-exit membership check) must not cancel the shared call
+        return await asyncio.shield(future)
+
+    def _finish(self, key, future):
+        if self._pending.get(key) is future:
+            del self._pending[key]
+        if not future.cancelled():
+            future.exception()  # mark as retrieved when every waiter has gone away
+
+single_flight = SingleFlight()
+
+metrics.Gauge("fsub_member_cache_hits_total", "Membership cache hits", lambda: membership_cache.hits, kind="counter")
+metrics.Gauge("fsub_member_cache_misses_total", "Membership cache misses", lambda: membership_cache.misses, kind="counter")
+metrics.Gauge("fsub_member_cache_entries", "Cached (user, channel) memberships", lambda: len(membership_cache._entries))
+metrics.Gauge("fsub_single_flight_coalesced_total", "Lookups served by a call already in flight", lambda: single_flight.coalesced, kind="counter")
+
+# Channel entities resolved so far; ids and access hashes don't change, so entries are kept
+channel_entities = {}  # channel_key -> entity
+
+async def resolve_entity(ref):
+    key = channel_key(ref)
+    entity = channel_entities.get(key)
+    if entity is not None:
+        return entity
+
+    async def fetch():
+        global channel_index
+        entity = await app.get_entity(ref)
+        channel_entities[key] = entity
+        channel_index = None  # a username-based channel can now be matched by id
+        return entity
+    return await single_flight.do(("entity", key), fetch)
+
+async def fetch_participant(channel, user_id, use_cache=True):
+    if use_cache and shared_membership is not None and await shared_membership.is_member(user_id, channel):
+        membership_cache.set(user_id, channel, True)
+        return True
+    target = channel_entities.get(channel_key(channel))
+    if target is None:
+        target = channel if isinstance(channel, int) else await resolve_entity(channel)
+    try:
+        await app(GetParticipantRequest(channel=target, participant=user_id))
+    except UserNotParticipantError:
+        membership_cache.set(user_id, channel, False)
+        return False
+    membership_cache.set(user_id, channel, True)
+    if shared_membership is not None:
+        await shared_membership.set(user_id, channel, True)
+    return True
+
+# Returns True/False for membership, raises on any other RPC error (not cached).
+# use_cache=False always asks Telegram, and stores the fresh answer.
+async def is_participant(channel, user_id, use_cache=True):
+    if use_cache:
+        cached = membership_cache.get(user_id, channel)
+        if cached is not None:
+            return cached
+    key = ("participant", channel_key(channel), user_id, use_cache)
+    return await single_flight.do(key, lambda: fetch_participant(channel, user_id, use_cache))
+
+# Per-chat cap on membership RPCs in flight; semaphores vanish once no check holds them
+check_semaphores = weakref.WeakValueDictionary()
+
+def get_check_semaphore(chat_id):
+    semaphore = check_semaphores.get(chat_id)
+    if semaphore is None:
+        semaphore = check_semaphores[chat_id] = asyncio.Semaphore(FSUB_CHECK_CONCURRENCY)
+    return semaphore
+
+# Checks all channels concurrently and returns the ones user_id has not joined.
+# With first_only the remaining RPCs are cancelled as soon as one channel is missing.
+# Errors other than "not a participant" are raised unless on_error is given, in
+# which case on_error(channel, exc) is called and that channel is skipped.
+async def find_missing_channels(chat_id, channels, user_id, first_only=True, on_error=None, use_cache=True):
+    missing = []
+    pending = []
+    for channel in channels:
+        cached = membership_cache.get(user_id, channel) if use_cache else None
+        if cached is None:
+            pending.append(channel)
+        elif not cached:
+            missing.append(channel)
+            if first_only:
+                return missing
+    if not pending:
+        return missing
+
+    semaphore = get_check_semaphore(chat_id)
+
+    async def check(channel):
+        async with semaphore:
+            try:
+                return channel, await is_participant(channel, user_id, use_cache)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(channel, e)
+                return channel, True
+
+    tasks = [asyncio.ensure_future(check(channel)) for channel in pending]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            channel, joined = await next_done
+            if not joined:
+                missing.append(channel)
+                if first_only:
+                    break
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    return missing
+
+# Invite links exported for private FSUB channels, reused until they are due for renewal.
+# Each link is created to expire one TTL after we stop handing it out, and a revoked
+# link is replaced at the next renewal.
+invite_links = {}  # (channel id, expires) -> (link, renew_at)
+
+# Links stored in group configs must not expire, so they are exported and cached apart
+# from the expiring ones in the FSUB prompts
+async def get_invite_link(channel, expires=True):
+    key = (channel.id, expires)
+    cached = invite_links.get(key)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    async def export():
+        if expires:
+            expire_date = datetime.utcnow() + timedelta(seconds=INVITE_LINK_TTL * 2)
+            invite = await app(ExportChatInviteRequest(channel, expire_date=expire_date))
+            invite_links[key] = (invite.link, time.time() + INVITE_LINK_TTL)
+        else:
+            invite = await app(ExportChatInviteRequest(channel))
+            invite_links[key] = (invite.link, math.inf)
+        return invite.link
+    return await single_flight.do(("invite",) + key, export)
+
+# A revoked link can't be told apart from a working one, so the cache is dropped
+# whenever a new link may be wanted
+def forget_invite_link(channel_id):
+    invite_links.pop((channel_id, True), None)
+    invite_links.pop((channel_id, False), None)
+
+# FSUB channels resolved at startup and refreshed in the background:
+# channel_key -> {"entity", "title", "username", "link"}
+owner_channels = {}
+
+async def load_owner_channel(ref):
+    global channel_index
+    entity = await app.get_entity(ref)
+    channel_entities[channel_key(ref)] = entity
+    channel_index = None
+    username = getattr(entity, "username", None)
+    link = f"https://t.me/{username}" if username else None
+    if link is None:
+        try:
+            link = await get_invite_link(entity)
+        except Exception as e:
+            logger.error(f"Error creating invite for {entity.id}: {e}")
+    owner_channels[channel_key(ref)] = {
+        "entity": entity,
+        "title": getattr(entity, "title", None),
+        "username": username,
+        "link": link,
+    }
+    return owner_channels[channel_key(ref)]
+
+async def refresh_owner_channels():
+    for ref in FSUB_IDS:
+        try:
+            await load_owner_channel(ref)
+        except Exception as e:
+            logger.error(f"Error resolving FSUB channel {ref}: {e}")
+
+# Resolves the channels that configs require, most shared first and at WARM_RATE
+# lookups per second, so the first checks after a restart don't all resolve at once
+async def warm_channel_entities():
+    shared_by = {}
+    refs = {}
+    for doc in list(forcesub_cache.values()):
+        if not doc.get("enabled", True):
+            continue
+        for channel in doc.get("channels") or ():
+            key = channel_key(channel["id"])
+            refs[key] = channel["id"]
+            shared_by[key] = shared_by.get(key, 0) + 1
+    warmed = 0
+    for key in sorted(refs, key=shared_by.get, reverse=True)[:WARM_ENTITY_LIMIT]:
+        if key in channel_entities:
+            continue
+        try:
+            await resolve_entity(refs[key])
+            warmed += 1
+        except Exception as e:
+            logger.warning(f"Could not resolve channel {refs[key]} while warming up: {e}")
+        await asyncio.sleep(1 / WARM_RATE)
+    logger.info(f"Warmed {warmed} channel entities")
+
+async def refresh_owner_channels_periodically():
+    while True:
+        await asyncio.sleep(ENTITY_REFRESH_INTERVAL)
+        for channel in list(owner_channels.values()):
+            forget_invite_link(channel["entity"].id)
+        await refresh_owner_channels()
+
 # Function to check owner's force subscription
 async def check_owner_fsub(user_id):
     if not FSUB_IDS or user_id == OWNER_ID:
         return True
 
+    def log_error(channel_id, e):
+        logger.error(f"Error checking user in channel {channel_id}: {e}")
+
+    # The prompt lists every channel still to join, so don't stop at the first one.
+    # Checks are capped per user (user ids never clash with group chat ids), not
+    # under one key shared by every command in the bot.
+    missing_ids = await find_missing_channels(user_id, FSUB_IDS, user_id, first_only=False, on_error=log_error)
     missing_subs = []
-    for channel_id in FSUB_IDS:
-        try:
-            if isinstance(channel_id, int):
-                await app(GetParticipantRequest(channel=channel_id, participant=user_id))
-            else:
-                channel_entity = await app.get_entity(channel_id)
-                await app(GetParticipantRequest(channel=channel_entity, participant=user_id))
-        except UserNotParticipantError:
+    for channel_id in missing_ids:
+        channel = owner_channels.get(channel_key(channel_id))
+        if channel is None:
             try:
-                channel = await app.get_entity(channel_id)
-                missing_subs.append(channel)
+                channel = await load_owner_channel(channel_id)
             except Exception as e:
                 logger.error(f"Error getting channel {channel_id}: {e}")
                 continue
-        except Exception as e:
-            logger.error(f"Error checking user in channel {channel_id}: {e}")
+        missing_subs.append(channel)
     return True if not missing_subs else missing_subs
 
 # Decorator to check force subscription compliance
 def check_fsub(func):
     async def wrapper(event):
         user_id = event.sender_id
+        await state_ready.wait()
+        if is_banned(user_id):
+            return
         if event.text and event.text.startswith('/'):
             missing_owner_subs = await check_owner_fsub(user_id)
             if missing_owner_subs is not True:
-                buttons = []
-                for channel in missing_owner_subs:
-                    if hasattr(channel, 'username') and channel.username:
-                        buttons.append([Button.url("๏ ᴊᴏɪɴ ๏", f"https://t.me/{channel.username}")])
-                    else:
-                        try:
-                            invite = await app(ExportChatInviteRequest(channel))
-                            buttons.append([Button.url("๏ ᴊᴏɪɴ ๏", invite.link)])
-                        except Exception as e:
-                            logger.error(f"Error creating invite for {channel.id}: {e}")
-                            continue
+                buttons = [[Button.url("๏ ᴊᴏɪɴ ๏", channel["link"])] for channel in missing_owner_subs if channel["link"]]
                 await event.reply(
                     "**⚠️ ᴀᴄᴄᴇss ʀᴇsᴛʀɪᴄᴛᴇᴅ ⚠️**\n\n"
                     "**ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴏᴜʀ ᴄʜᴀɴɴᴇʟ(s) ᴛᴏ ᴜsᴇ ᴛʜᴇ ʙᴏᴛ!**\n"
@@ -131,19 +1117,20 @@ def check_fsub(func):
         return await func(event)
     return wrapper
 
-# Utility function to check if command is meant for this bot
-async def is_command_for_me(event):
-    try:
-        me = await app.get_me()
-        bot_username = me.username
-        parts = event.text.split('@', 1)
-        if len(parts) > 1:
-            target_bot = parts[1].strip().lower()
-            return target_bot == bot_username.lower()
-        return True
-    except Exception as e:
-        logger.error(f"Error checking command target: {e}")
-        return True
+# Bot identity, resolved once at startup instead of calling get_me() per update
+BOT_ID = None
+BOT_USERNAME = None
+
+async def load_bot_identity():
+    global BOT_ID, BOT_USERNAME
+    me = await app.get_me()
+    BOT_ID = me.id
+    BOT_USERNAME = (me.username or "").lower()
+
+async def get_bot_id():
+    if BOT_ID is None:
+        await load_bot_identity()
+    return BOT_ID
 
 # Global admin check function
 async def is_admin_or_owner(chat_id, user_id):
@@ -156,24 +1143,112 @@ async def is_admin_or_owner(chat_id, user_id):
         logger.error(f"Error checking admin status: {e}")
         return False
 
+# Messages for LOGGER_ID, sent in the background so a log never delays a reply.
+# Events collected over LOG_FLUSH_INTERVAL go out as one digest message, or as one
+# album when they carry profile photos (downloaded into memory, never to disk).
+# Past LOG_QUEUE_SIZE, low priority events are dropped to make room.
+class LogPipeline:
+    def __init__(self, max_size, batch_size, interval):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.high = deque()
+        self.low = deque()
+        self.pending = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def depth(self):
+        return len(self.high) + len(self.low)
+
+    # photo_of: a user whose current profile photo is attached to the event
+    def submit(self, text, high=False, photo_of=None):
+        if not LOGGER_ID:
+            return
+        if self.depth() >= self.max_size:
+            if not high or not self.low:
+                self.dropped += 1
+                return
+            self.low.popleft()
+            self.dropped += 1
+        (self.high if high else self.low).append((text, photo_of))
+        self.pending.set()
+
+    def take(self):
+        batch = []
+        while len(batch) < self.batch_size and (self.high or self.low):
+            batch.append((self.high or self.low).popleft())
+        return batch
+
+    async def run(self):
+        rpc_priority.set(PRIORITY_LOW)
+        while True:
+            await self.pending.wait()
+            await asyncio.sleep(self.interval)
+            self.pending.clear()
+            while self.depth():
+                batch = self.take()
+                try:
+                    await self.send(batch)
+                    self.sent += len(batch)
+                except FloodWaitError as e:
+                    logger.warning(f"Flood wait of {e.seconds}s while sending logs")
+                    await asyncio.sleep(e.seconds)
+                except Exception as e:
+                    logger.error(f"Error sending {len(batch)} log events: {e}")
+
+    async def send(self, batch):
+        texts = []
+        album = []
+        for text, photo_of in batch:
+            photo = await self.download_photo(photo_of) if photo_of is not None else None
+            if photo is None:
+                texts.append(text)
+            else:
+                album.append((photo, text))
+        if album:
+            await app.send_file(LOGGER_ID, [photo for photo, _ in album], caption=[text for _, text in album])
+        # Telegram caps a message at 4096 characters
+        digest = ""
+        for text in texts:
+            if digest and len(digest) + len(text) + 2 > 4096:
+                await app.send_message(LOGGER_ID, digest)
+                digest = ""
+            digest = f"{digest}\n\n{text}" if digest else text
+        if digest:
+            await app.send_message(LOGGER_ID, digest)
+
+    async def download_photo(self, user):
+        try:
+            async for p in app.iter_profile_photos(user, limit=1):
+                photo = io.BytesIO(await app.download_media(p, file=bytes))
+                photo.name = "photo.jpg"
+                return photo
+        except Exception as e:
+            logger.warning(f"Could not download profile photo for the log: {e}")
+        return None
+
+log_pipeline = LogPipeline(LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+metrics.Gauge("fsub_log_queue_depth", "Log events waiting to be sent", lambda: log_pipeline.depth())
+metrics.Gauge("fsub_log_dropped_total", "Log events dropped because the queue was full", lambda: log_pipeline.dropped, kind="counter")
+
 @app.on(events.ChatAction)
+@timed_handler
 async def handle_added_to_chat(event):
     if hasattr(event, 'user_left') and event.user_left:
-        me = await app.get_me()
-        if event.user_id == me.id:
+        if event.user_id == await get_bot_id():
             await remove_group(event.chat_id)
     if event.user_added:
-        me = await app.get_me()
-        if event.user_id == me.id:
+        if event.user_id == await get_bot_id():
             chat = await event.get_chat()
-            await add_group(chat.id)
+            add_group(chat.id)
             chat_link = f"https://t.me/{chat.username}" if chat.username else "Private Group"
-            await app.send_message(
-                LOGGER_ID,
+            log_pipeline.submit(
                 f"**🔔 ʙᴏᴛ ᴀᴅᴅᴇᴅ ᴛᴏ ɴᴇᴡ ᴄʜᴀᴛ**\n\n"
                 f"**ᴄʜᴀᴛ ɴᴀᴍᴇ:** {chat.title}\n"
                 f"**ᴄʜᴀᴛ ɪᴅ:** `{chat.id}`\n"
-                f"**ʟɪɴᴋ:** {chat_link}"
+                f"**ʟɪɴᴋ:** {chat_link}",
+                high=True
             )
             # Intro message in group with required permissions info
             intro_text = (
@@ -183,13 +1258,53 @@ async def handle_added_to_chat(event):
             )
             await app.send_message(chat.id, intro_text)
 
-@app.on(events.NewMessage(pattern=r"^/start(?:@\w+)?$"))
+# Registered before every other message handler so banned users stop here in private chats
+@app.on(events.NewMessage(func=lambda e: e.is_private))
+@timed_handler
+async def check_ban(event):
+    await state_ready.wait()
+    if is_banned(event.sender_id):
+        await event.reply("**🚫 ʏᴏᴜ ᴀʀᴇ ʙᴀɴɴᴇᴅ ғʀᴏᴍ ᴜsɪɴɢ ᴛʜɪs ʙᴏᴛ.**")
+        raise events.StopPropagation
+
+# Command router: one handler parses "/cmd@botname args" once and looks the command up,
+# instead of every command registering its own NewMessage pattern
+COMMAND_RE = re.compile(r"^/(\w+)(?:@(\w+))?(?:\s+(.*))?$", re.DOTALL)
+commands = {}  # name -> (handler, group_only)
+
+def command(*names, group_only=False):
+    def decorator(func):
+        for name in names:
+            commands[name] = (func, group_only)
+        return func
+    return decorator
+
+@app.on(events.NewMessage(pattern=r"^/"))
+@timed_handler
+async def dispatch_command(event):
+    match = COMMAND_RE.match(event.raw_text)
+    if not match:
+        return
+    name, target, args = match.groups()
+    entry = commands.get(name)
+    if entry is None:
+        return
+    if target and BOT_USERNAME is None:
+        await load_bot_identity()  # an update that arrived while main() was loading it
+    if target and BOT_USERNAME and target.lower() != BOT_USERNAME:
+        return
+    handler, group_only = entry
+    if group_only and not event.is_group:
+        return
+    event.command_args = (args or "").strip()
+    with HANDLER_SECONDS.time(handler=f"/{name}"):
+        await handler(event)
+
+@command("start")
 @check_fsub
 async def start(event):
-    if not await is_command_for_me(event):
-        return
     user_id = event.sender_id
-    await add_user(user_id)
+    add_user(user_id)
     user = await event.get_sender()
     buttons = [
         [Button.url("• ᴧᴅᴅ мᴇ ʙᴧʙʏ •", "https://t.me/Era_Roxbot?startgroup=true")],
@@ -202,20 +1317,13 @@ async def start(event):
         f"**👋 ʜᴇʟʟᴏ! {mention}\n\nᴡᴇʟᴄᴏᴍᴇ ᴛᴏ ᴛʜᴇ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ʙᴏᴛ.**\n\n**➲ ᴜsᴇ ᴛʜɪs ʙᴏᴛ ᴛᴏ ᴇɴғᴏʀᴄᴇ ᴜsᴇʀs ᴛᴏ ᴊᴏɪɴ ᴄʜᴀɴɴᴇʟs ᴏʀ ɢʀᴏᴜᴘs ʙᴇғᴏʀᴇ ᴛʜᴇʏ ᴄᴀɴ sᴇɴᴅ ᴍᴇssᴀɢᴇs ɪɴ ᴀ ɢʀᴏᴜᴘ.**\n\n**➲ ᴛʏᴘᴇ /help ғᴏʀ ᴍᴏʀᴇ ɪɴғᴏʀᴍᴀᴛɪᴏɴ.**",
         buttons=buttons
     )
-    photo = None
-    async for p in app.iter_profile_photos(user, limit=1):
-        photo = await app.download_media(p)
-        break
     message = f"✨ **User Activity Log**\n━━━━━━━━━━━━━━━━━━━\n👤 **User ID:** `{user_id}`\n🙋 **Name:** {mention}\n🔗 **Username:** @{user.username if user.username else 'No User name'}\n🔄 **Action:** Started the bot\n⏰ **Time:** `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`\n📡 **Bot Status:** Active\n━━━━━━━━━━━━━━━━━━━\n💎 _Welcome to our bot!_"
-    #asyncio.create_task(app.send_message(LOGGER_ID, message, file=photo))
-    await app.send_message(LOGGER_ID, message, file=photo)
+    log_pipeline.submit(message, photo_of=user)
 
 
-@app.on(events.NewMessage(pattern=r"^/help(?:@\w+)?$"))
+@command("help")
 @check_fsub
 async def help(event):
-    if not await is_command_for_me(event):
-        return
     await event.reply(
         "**📖 ʜᴇʟʟᴘ ᴍᴇɴᴜ:**\n\n"
         "**/set <ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ ᴏʀ ɪᴅ ᴏʀ ʟɪɴᴋ> (ᴜᴘ ᴛᴏ 4)** - ᴛᴏ sᴇᴛ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ғᴏʀ ᴀ ɢʀᴏᴜᴘ.\n"
@@ -224,29 +1332,29 @@ async def help(event):
         "**/start** - ᴛᴏ ᴅɪsᴘʟᴀʏ ᴛʜᴇ ᴡᴇʟᴄᴏᴍᴇ ᴍᴇssᴀɢᴇ.\n"
         "**/help** - ᴛᴏ ᴅɪsᴘʟᴀʏ ᴛʜᴇ ʜᴇʟʟᴘ ᴍᴇɴᴜ.\n"
         "**/stats** - ᴛᴏ ᴠɪᴇᴡ ʙᴏᴛ sᴛᴀᴛɪsᴛɪᴄs.\n"
+        "**/perf** - ᴛᴏ ᴠɪᴇᴡ ᴘᴇʀғᴏʀᴍᴀɴᴄᴇ ᴍᴇᴛʀɪᴄs.\n"
         "**/broadcast <ᴍᴇssᴀɢᴇ>** - ᴛᴏ ʙʀᴏᴀᴅᴄᴀsᴛ ᴀ ᴍᴇssᴀɢᴇ ᴛᴏ ᴀʟʟ ᴜsᴇʀs.\n"
         "**/ban <ᴜsᴇʀ ɪᴅ>** - ᴛᴏ ʙᴀɴ ᴀ ᴜsᴇʀ.\n"
         "**/unban <ᴜsᴇʀ ɪᴅ>** - ᴛᴏ ᴜɴʙᴀɴ ᴀ ᴜsᴇʀ.\n\n"
         "**➲ ᴛʜᴇsᴇ ᴄᴏᴍᴍᴀɴᴅs ᴏɴʟʏ ᴡᴏʀᴋ ɪɴ ɢʀᴏᴜᴘs:**\n"
         "**/set** - ᴛᴏ sᴇᴛ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ.\n"
         "**/fsub** - ᴛᴏ ᴍᴀɴᴀɢᴇ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ.\n"
-        "**/reset** - ᴛᴏ ʀᴇsᴇᴛ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ.\n\n"
+        "**/reset** - ᴛᴏ ʀᴇsᴇᴛ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ.\n"
+        "**/fsubstats** - ᴛᴏ ᴠɪᴇᴡ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ sᴛᴀᴛɪsᴛɪᴄs.\n\n"
         "**➲ ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜᴇsᴇ ᴄᴏᴍᴍᴀɴᴅs.**"
     )
 
-@app.on(events.NewMessage(pattern=r"^/set(?:@\w+)?( .+)?$", func=lambda e: e.is_group))
+@command("set", group_only=True)
 @check_fsub
 async def set_forcesub(event):
-    if not await is_command_for_me(event):
-        return
     chat_id = event.chat_id
     user_id = event.sender_id
 
     if not await is_admin_or_owner(chat_id, user_id):
         return await event.reply("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
 
-    await add_group(chat_id)
-    command = event.pattern_match.group(1)
+    add_group(chat_id)
+    command = event.command_args
     if not command:
         return await event.reply("**ᴜsᴀɢᴇ: /set <ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ ᴏʀ ɪᴅ ᴏʀ ʟɪɴᴋ> (ᴜᴘ ᴛᴏ 4)**")
 
@@ -254,6 +1362,8 @@ async def set_forcesub(event):
     if len(channels) > 4:
         return await event.reply("**🚫 ʏᴏᴜ ᴄᴀɴ ᴏɴʟʏ ᴀᴅᴅ ᴜᴘ ᴛᴏ 4 ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴs.**")
 
+    # Setting a channel again is how an admin replaces a link that was revoked
+    current = {channel_key(c["id"]) for c in (get_forcesub(chat_id) or {}).get("channels") or ()}
     fsub_data = []
     for channel_input in channels:
         try:
@@ -261,9 +1371,9 @@ async def set_forcesub(event):
                 channel_input = channel_input.replace("https://t.me/", "")
             try:
                 channel_id = int(channel_input)
-                channel_entity = await app.get_entity(channel_id)
+                channel_entity = await resolve_entity(channel_id)
             except ValueError:
-                channel_entity = await app.get_entity(channel_input)
+                channel_entity = await resolve_entity(channel_input)
                 channel_id = channel_entity.id
             channel_info = await app(GetFullChannelRequest(channel_entity))
             channel_title = channel_info.chats[0].title
@@ -271,9 +1381,10 @@ async def set_forcesub(event):
                 channel_username = f"@{channel_info.chats[0].username}"
                 channel_link = f"https://t.me/{channel_info.chats[0].username}"
             else:
-                invite = await app(ExportChatInviteRequest(channel_id))
-                channel_username = invite.link
-                channel_link = invite.link
+                if channel_key(channel_entity.id) in current:
+                    forget_invite_link(channel_entity.id)
+                channel_link = await get_invite_link(channel_entity, expires=False)
+                channel_username = channel_link
             fsub_data.append({
                 "id": channel_id,
                 "username": channel_username,
@@ -284,11 +1395,7 @@ async def set_forcesub(event):
             logger.error(f"Error fetching channel info for {channel_input}: {e}")
             return await event.reply(f"**🚫 ғᴀɪʟᴇᴅ ᴛᴏ ғᴇᴛᴄʜ ᴅᴀᴛᴀ ғᴏʀ {channel_input}.**")
 
-    await forcesub_collection.update_one(
-        {"chat_id": chat_id},
-        {"$set": {"channels": fsub_data, "enabled": True}},
-        upsert=True
-    )
+    await save_forcesub(chat_id, {"channels": fsub_data, "enabled": True})
 
     set_by_user = f"@{event.sender.username}" if event.sender.username else event.sender.first_name
     channel_list = "\n".join([f"**{c['title']}** ({c['username']})" for c in fsub_data])
@@ -304,37 +1411,46 @@ async def set_forcesub(event):
     else:
         await event.reply(f"**🎉 ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ sᴇᴛ ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ:**\n\n{channel_list}")
 
-@app.on(events.NewMessage(pattern=r"^/fsub(?:@\w+)?$", func=lambda e: e.is_group))
+@command("fsub", group_only=True)
 @check_fsub
 async def manage_forcesub(event):
-    if not await is_command_for_me(event):
-        return
     chat_id = event.chat_id
     user_id = event.sender_id
 
     if not await is_admin_or_owner(chat_id, user_id):
         return await event.reply("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
 
-    forcesub_data = await forcesub_collection.find_one({"chat_id": chat_id})
+    forcesub_data = get_forcesub(chat_id)
     if not forcesub_data or not forcesub_data.get("channels") or not forcesub_data.get("enabled", True):
         return await event.reply("**🚫 ɴᴏ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs sᴇᴛ ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ.**")
 
+    text, buttons = forcesub_menu(chat_id, forcesub_data)
+    await event.reply(text, buttons=buttons)
+
+# "strict" checks every message, "trust" lets users verified within TRUST_WINDOW through
+FSUB_MODES = {"strict": "sᴛʀɪᴄᴛ", "trust": "ᴛʀᴜsᴛ ᴡɪɴᴅᴏᴡ"}
+
+def forcesub_menu(chat_id, forcesub_data):
     channel_list = "\n".join([f"**{c['title']}** ({c['username']})" for c in forcesub_data["channels"]])
     is_enabled = forcesub_data.get("enabled", True)
-    
-    callback_data = f"fsub_toggle_{chat_id}_{1 if not is_enabled else 0}"
-    
-    buttons = [[Button.inline("🔴 ᴛᴜʀɴ ᴏғғ" if is_enabled else "🟢 ᴛᴜʀɴ ᴏɴ", callback_data)]]
-
-    await event.reply(
+    mode = forcesub_data.get("mode", "strict")
+    next_mode = "strict" if mode == "trust" else "trust"
+    buttons = [
+        [Button.inline("🔴 ᴛᴜʀɴ ᴏғғ" if is_enabled else "🟢 ᴛᴜʀɴ ᴏɴ", f"fsub_toggle_{chat_id}_{1 if not is_enabled else 0}")],
+        [Button.inline(f"🛡️ sᴡɪᴛᴄʜ ᴛᴏ {FSUB_MODES[next_mode]}", f"fsub_mode_{chat_id}_{next_mode}")],
+    ]
+    text = (
         f"**📊 ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ:**\n\n"
         f"{channel_list}\n\n"
-        f"**ᴄᴜʀʀᴇɴᴛ sᴛᴀᴛᴜs:** {'🟢 ᴏɴ' if is_enabled else '🔴 ᴏғғ'}",
-        buttons=buttons
+        f"**ᴄᴜʀʀᴇɴᴛ sᴛᴀᴛᴜs:** {'🟢 ᴏɴ' if is_enabled else '🔴 ᴏғғ'}\n"
+        f"**ᴍᴏᴅᴇ:** {FSUB_MODES[mode]}"
     )
+    return text, buttons
 
 @app.on(events.CallbackQuery(pattern=r"fsub_toggle_(\-?\d+)_([01])"))
+@timed_handler
 async def toggle_forcesub(event):
+    await state_ready.wait()
     try:
         chat_id = int(event.pattern_match.group(1))
         new_state = bool(int(event.pattern_match.group(2)))
@@ -345,27 +1461,15 @@ async def toggle_forcesub(event):
         if not await is_admin_or_owner(chat_id, user_id):
             return await event.answer("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs.**", alert=True)
 
-        forcesub_data = await forcesub_collection.find_one({"chat_id": chat_id})
+        forcesub_data = get_forcesub(chat_id)
         if not forcesub_data:
             return await event.answer("**ɴᴏ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs sᴇᴛ.**", alert=True)
 
-        await forcesub_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {"enabled": new_state}}
-        )
+        await save_forcesub(chat_id, {"enabled": new_state}, upsert=False)
         logger.info(f"Database updated for chat {chat_id}, new state: {new_state}")
 
-        channel_list = "\n".join([f"**{c['title']}** ({c['username']})" for c in forcesub_data["channels"]])
-        next_state = not new_state
-        new_buttons = [[Button.inline("🔴 ᴛᴜʀɴ ᴏғғ" if new_state else "🟢 ᴛᴜʀɴ ᴏɴ",
-                            f"fsub_toggle_{chat_id}_{1 if next_state else 0}")]]
-    
-        await event.edit(
-            f"**📊 ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ:**\n\n"
-            f"{channel_list}\n\n"
-            f"**ᴄᴜʀʀᴇɴᴛ sᴛᴀᴛᴜs:** {'🟢 ᴏɴ' if new_state else '🔴 ᴏғғ'}",
-            buttons=new_buttons
-        )
+        text, buttons = forcesub_menu(chat_id, get_forcesub(chat_id))
+        await event.edit(text, buttons=buttons)
         
         await event.answer(
             f"**✅ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ {new_state and 'enabled' or 'disabled'} sᴜᴄᴄᴇssғᴜʟʟʏ!**",
@@ -377,99 +1481,551 @@ async def toggle_forcesub(event):
         logger.error(f"Error in toggle_forcesub: {str(e)}")
         await event.answer("**❌ ᴀɴ ᴇʀʀᴏʀ occᴜʀᴇᴅ.**", alert=True)
 
+@app.on(events.CallbackQuery(pattern=r"fsub_mode_(\-?\d+)_(strict|trust)"))
+@timed_handler
+async def toggle_forcesub_mode(event):
+    await state_ready.wait()
+    try:
+        chat_id = int(event.pattern_match.group(1))
+        mode = event.pattern_match.group(2).decode()
+        if not await is_admin_or_owner(chat_id, event.sender_id):
+            return await event.answer("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs.**", alert=True)
+
+        if not get_forcesub(chat_id):
+            return await event.answer("**ɴᴏ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs sᴇᴛ.**", alert=True)
+
+        await save_forcesub(chat_id, {"mode": mode}, upsert=False)
+        text, buttons = forcesub_menu(chat_id, get_forcesub(chat_id))
+        await event.edit(text, buttons=buttons)
+        await event.answer(f"**✅ ᴍᴏᴅᴇ sᴇᴛ ᴛᴏ {FSUB_MODES[mode]}!**", alert=True)
+    except Exception as e:
+        logger.error(f"Error in toggle_forcesub_mode: {e}")
+        await event.answer("**❌ ᴀɴ ᴇʀʀᴏʀ occᴜʀᴇᴅ.**", alert=True)
+
 #-----------
-@app.on(events.NewMessage)
-async def check_fsub_handler(event):
-    if hasattr(event, '_fsub_checked'):
+# Messages waiting to be deleted, sent as one delete_messages call per chat shortly
+# after the first one arrives so a burst of spam costs a single request
+pending_deletes = {}  # chat_id -> list of (message id, kind)
+
+def queue_delete(chat_id, message_id, kind="message"):
+    if chat_id not in pending_deletes:
+        pending_deletes[chat_id] = []
+        spawn(flush_deletes(chat_id))
+    pending_deletes[chat_id].append((message_id, kind))
+
+async def flush_deletes(chat_id):
+    rpc_priority.set(PRIORITY_HIGH)  # may be spawned from a low-priority task
+    await asyncio.sleep(DELETE_BATCH_DELAY)
+    pending = pending_deletes.pop(chat_id, [])
+    for i in range(0, len(pending), 100):
+        batch = pending[i:i + 100]
+        try:
+            await app.delete_messages(chat_id, [message_id for message_id, _ in batch])
+            for kind in ("message", "prompt"):
+                count = sum(1 for _, k in batch if k == kind)
+                if count:
+                    MESSAGES_DELETED.inc(count, kind=kind)
+        except Exception as e:
+            logger.error(f"Could not delete messages in {chat_id}: {e}")
+
+# One join prompt per (chat, user) per WARNING_WINDOW; the prompt is removed when the
+# window ends or the user joins
+warnings = {}  # (chat_id, user_id) -> (prompt message id, expires_at)
+
+async def warn_non_member(chat_id, user_id, name):
+    warning = warnings.get((chat_id, user_id))
+    if warning and warning[1] > time.monotonic():
         return
+    # Claim the window before sending so concurrent messages don't each send a prompt
+    expires_at = time.monotonic() + WARNING_WINDOW
+    warnings[(chat_id, user_id)] = (None, expires_at)
+    mention = f"[{name}](tg://user?id={user_id})"
+    try:
+        prompt = await app.send_message(
+            chat_id,
+            JOIN_PROMPT.format(mention=mention),
+            buttons=get_join_buttons(chat_id),
+            link_preview=False
+        )
+    except Exception:
+        warnings.pop((chat_id, user_id), None)
+        raise
+    enforcement_stats.record(chat_id, "warned")
+    if (chat_id, user_id) in warnings:
+        warnings[(chat_id, user_id)] = (prompt.id, expires_at)
+    else:
+        queue_delete(chat_id, prompt.id, kind="prompt")  # cleared (user joined) while the prompt was being sent
 
-    user_id = event.sender_id
-    if event.is_group:
-        chat_id = event.chat_id
-        forcesub_data = await forcesub_collection.find_one({"chat_id": chat_id})
-        if not forcesub_data or not forcesub_data.get("channels") or not forcesub_data.get("enabled", True):
-            return
+def clear_warning(chat_id, user_id):
+    warning = warnings.pop((chat_id, user_id), None)
+    if warning and warning[0] is not None:
+        queue_delete(chat_id, warning[0], kind="prompt")
+
+async def expire_warnings():
+    while True:
+        await asyncio.sleep(max(1, WARNING_WINDOW / 4))
+        now = time.monotonic()
+        for key, (_, expires_at) in list(warnings.items()):
+            if expires_at <= now:
+                clear_warning(*key)
+
+# Users who recently passed the check in a group, for groups in "trust" mode:
+# (chat_id, user_id) -> time of the last verification, oldest first. Past
+# TRUST_MAX_USERS the oldest verifications are dropped.
+class TrustWindow:
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._verified = OrderedDict()
+
+    def add(self, chat_id, user_id):
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        self._verified[key] = now
+        self._verified.move_to_end(key)
+        # Expired entries are at the front
+        while self._verified and (len(self._verified) > self.max_size or next(iter(self._verified.values())) + self.window <= now):
+            self._verified.popitem(last=False)
+
+    def is_trusted(self, chat_id, user_id):
+        verified_at = self._verified.get((chat_id, user_id))
+        if verified_at is None:
+            return False
+        if verified_at + self.window <= time.monotonic():
+            del self._verified[(chat_id, user_id)]
+            return False
+        return True
+
+    def forget(self, chat_id, user_id):
+        self._verified.pop((chat_id, user_id), None)
+
+    def __len__(self):
+        return len(self._verified)
+
+trust_window = TrustWindow(TRUST_WINDOW, TRUST_MAX_USERS)
+metrics.Gauge("fsub_trust_window_users", "Users trusted without a check in trust-mode groups", lambda: len(trust_window))
+
+# Checks one group message; returns True only when the sender passed the check. Takes
+# plain values rather than the event so it can also run outside the update handler.
+# In "trust" mode a user verified within TRUST_WINDOW passes straight away, and only
+# TRUST_RECHECK_RATE of those messages are verified again in the background.
+async def enforce_fsub(chat_id, user_id, message_id, name):
+    forcesub_data = get_forcesub(chat_id)
+    if not forcesub_data or not forcesub_data.get("channels") or not forcesub_data.get("enabled", True):
+        return False
+
+    enforcement_stats.record(chat_id, "checked")
+    if forcesub_data.get("mode") == "trust" and trust_window.is_trusted(chat_id, user_id):
+        if random.random() < TRUST_RECHECK_RATE:
+            spawn(verify_member(chat_id, user_id, message_id, name, forcesub_data, use_cache=False))
+        return True
+    return await verify_member(chat_id, user_id, message_id, name, forcesub_data)
+
+# Checks that ran into a flood-wait pause on membership lookups. Rather than letting
+# the message through they are queued again once the pause is over; past
+# FSUB_QUEUE_SIZE waiting checks the oldest are given up.
+CHECKS_DEFERRED = metrics.Counter("fsub_checks_deferred_total", "Membership checks put off by a flood wait, by outcome")
+deferred_checks = deque(maxlen=FSUB_QUEUE_SIZE)
+deferred_task = None
+
+def defer_check(chat_id, user_id, message_id, name, seconds):
+    global deferred_task
+    if len(deferred_checks) == deferred_checks.maxlen:
+        CHECKS_DEFERRED.inc(result="dropped")
+    deferred_checks.append((chat_id, user_id, message_id, name))
+    CHECKS_DEFERRED.inc(result="deferred")
+    if deferred_task is None or deferred_task.done():
+        deferred_task = spawn(retry_deferred_checks(seconds))
+
+async def retry_deferred_checks(seconds):
+    await asyncio.sleep(seconds)
+    logger.info(f"Retrying {len(deferred_checks)} checks put off by a flood wait")
+    while deferred_checks:
+        await enforcement_queue.submit(*deferred_checks.popleft())
+
+async def verify_member(chat_id, user_id, message_id, name, forcesub_data, use_cache=True):
+    channel_ids = [channel["id"] for channel in forcesub_data["channels"]]
+    try:
+        is_member = not await find_missing_channels(chat_id, channel_ids, user_id, use_cache=use_cache)
+    except FloodWaitError as e:
+        defer_check(chat_id, user_id, message_id, name, e.seconds)
+        return False
+    except Exception as e:
+        if "Could not find the input entity" in str(e):
+            logger.warning(f"Could not check user {user_id} in chat {chat_id} channels: {e}")
+            is_member = False
+        else:
+            logger.error(f"An error occurred while checking user participation: {e}")
+            return False
+
+    if not is_member:
+        trust_window.forget(chat_id, user_id)
+        queue_delete(chat_id, message_id)
+        enforcement_stats.record(chat_id, "deleted")
+        try:
+            await warn_non_member(chat_id, user_id, name)
+        except Exception as e:
+            logger.error(f"An error occurred while sending the force sub message: {e}")
+        return False
+    if forcesub_data.get("mode") == "trust":
+        trust_window.add(chat_id, user_id)
+    return True
+
+# Whether a message may skip its check under the "trusted" overflow policy: the user
+# is cached as a member of every channel, or is in the trust window of a trust-mode group
+def known_member(chat_id, user_id):
+    forcesub_data = get_forcesub(chat_id)
+    if not forcesub_data or not forcesub_data.get("channels"):
+        return True
+    if forcesub_data.get("mode") == "trust" and trust_window.is_trusted(chat_id, user_id):
+        return True
+    return all(membership_cache.get(user_id, c["id"]) for c in forcesub_data["channels"])
+
+# Group messages are enforced by a fixed pool of workers, each with its own bounded
+# queue. A chat always maps to the same worker, so its messages are checked in order.
+# When a queue is full FSUB_OVERFLOW_POLICY decides: "block" waits for room (slowing
+# update handling down), "trusted" skips the check for users known to be members
+# (see known_member) and waits for the rest, "shed" skips the check altogether.
+# Telethon runs every update in its own task, so waiting doesn't stop new updates
+# from arriving; past max_blocked waiting handlers, further messages are shed too.
+OVERFLOW_POLICIES = ("block", "trusted", "shed")
+
+class EnforcementQueue:
+    def __init__(self, workers, size, policy, stride=1, max_blocked=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown FSUB_OVERFLOW_POLICY {policy!r}, expected one of {', '.join(OVERFLOW_POLICIES)}")
+        self.queues = [asyncio.Queue(maxsize=max(1, size // workers)) for _ in range(workers)]
+        self.policy = policy
+        self.max_blocked = size if max_blocked is None else max_blocked
+        self.blocked = 0  # handlers waiting for room in a full queue
+        # In a shard, hash(chat_id) % shards is fixed, so workers are picked from the
+        # rest of the hash; otherwise only workers / shards of them would ever be used
+        self.stride = stride
+        self.max_depth = 0
+        self.waits = deque(maxlen=1000)  # recent queue wait times in seconds
+        self.processed = 0
+        self.dropped = 0
+        self.workers = []
+
+    def start(self):
+        self.workers = [spawn(self.worker(queue)) for queue in self.queues]
 
-        is_member = True
-        for channel in forcesub_data["channels"]:
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def submit(self, chat_id, user_id, message_id, name):
+        queue = self.queues[hash(chat_id) // self.stride % len(self.queues)]
+        item = (time.monotonic(), chat_id, user_id, message_id, name)
+        if queue.full():
+            if self.policy == "shed" or (self.policy == "trusted" and known_member(chat_id, user_id)):
+                self.dropped += 1
+                return
+            if self.blocked >= self.max_blocked:
+                self.dropped += 1
+                return
+            self.blocked += 1
             try:
-                if isinstance(channel["id"], int):
-                    await app(GetParticipantRequest(channel=channel["id"], participant=user_id))
-                else:
-                    channel_entity = await app.get_entity(channel["id"])
-                    await app(GetParticipantRequest(channel=channel_entity, participant=user_id))
-            except UserNotParticipantError:
-                is_member = False
-                break
+                await queue.put(item)
+            finally:
+                self.blocked -= 1
+        else:
+            queue.put_nowait(item)
+        self.max_depth = max(self.max_depth, self.depth())
+
+    async def worker(self, queue):
+        rpc_priority.set(PRIORITY_HIGH)
+        await state_ready.wait()
+        while True:
+            queued_at, chat_id, user_id, message_id, name = await queue.get()
+            self.waits.append(time.monotonic() - queued_at)
+            try:
+                with HANDLER_SECONDS.time(handler="enforce_fsub"):
+                    await enforce_fsub(chat_id, user_id, message_id, name)
             except Exception as e:
-                if "Could not find the input entity" in str(e):
-                    logger.warning(f"Could not check user {user_id} in channel {channel['id']}: {e}")
-                    is_member = False
-                    break
-                else:
-                    logger.error(f"An error occurred while checking user participation: {e}")
+                logger.error(f"Error enforcing force-sub in {chat_id}: {e}")
+            finally:
+                self.processed += 1
+                queue.task_done()
+
+    def wait_percentile(self, pct):
+        if not self.waits:
+            return 0.0
+        ordered = sorted(self.waits)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    # The user is now a member of every channel the chat requires
+    def joined(self, chat_id, user_id):
+        clear_warning(chat_id, user_id)
+
+    # A join/leave update already applied to the local membership cache; chats are
+    # the groups requiring the channel
+    def member_changed(self, user_id, keys, chats, joined):
+        if not joined:
+            for chat_id in chats:
+                trust_window.forget(chat_id, user_id)
+
+    async def stop(self):
+        for queue in self.queues:
+            await queue.join()
+
+# Sharded mode (SHARDS > 1): this process keeps receiving every update, and group
+# messages are forwarded in batches to SHARDS worker processes, each running its own
+# EnforcementQueue. A chat always goes to the same shard, so its join prompts and
+# pending deletes live in one place. The shards share force-sub configs through Mongo
+# and, with REDIS_URL, membership answers through Redis.
+SHARD_RESTARTS = metrics.Counter("fsub_shard_restarts_total", "Shard processes started again after they exited")
+
+class ShardedEnforcementQueue(EnforcementQueue):
+    def __init__(self, shards, size, policy, target=None, max_blocked=None):
+        super().__init__(shards, size, policy, max_blocked=max_blocked)
+        self.context = multiprocessing.get_context("spawn")
+        self.pipes = [None] * shards
+        self.target = target
+        self.processes = [None] * shards
+        self.restarts = [0] * shards  # restarts in a row, reset once a shard stays up
+        self.watcher = None
+        self.stopping = False
+        # Blocking puts on a full pipe wait here instead of on the event loop; one
+        # thread per shard for check batches and one for notices
+        self.executor = ThreadPoolExecutor(max_workers=shards * 2, thread_name_prefix="shard-pipe")
+
+    # A dead shard may have held the pipe's read lock, so every start gets a new pipe;
+    # puts still waiting on the old one give up after SHARD_PUT_TIMEOUT
+    def start_shard(self, index):
+        self.pipes[index] = self.context.Queue(maxsize=64)
+        os.environ["FSUB_SHARD_INDEX"] = str(index)
+        os.environ["FSUB_SHARD_COUNT"] = str(len(self.pipes))
+        try:
+            process = self.context.Process(target=self.target or run_shard, args=(index, self.pipes[index]), daemon=True)
+            process.start()
+        finally:
+            del os.environ["FSUB_SHARD_INDEX"]
+            del os.environ["FSUB_SHARD_COUNT"]
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.pipes)):
+            self.start_shard(index)
+        super().start()
+        self.watcher = spawn(self.watch())
+
+    # Restarts shards that exit; one that keeps dying (a bad session, a crash at start)
+    # takes the bot down instead of leaving its groups unchecked
+    async def watch(self):
+        while not self.stopping:
+            await asyncio.sleep(5)
+            for index, process in enumerate(self.processes):
+                if self.stopping:
+                    return
+                if process.is_alive():
+                    self.restarts[index] = 0
+                    continue
+                self.restarts[index] += 1
+                if self.restarts[index] > SHARD_MAX_RESTARTS:
+                    logger.critical(f"Shard {index} exited {SHARD_MAX_RESTARTS} times in a row (exit code {process.exitcode}), stopping the bot")
+                    await app.disconnect()
                     return
+                logger.error(f"Shard {index} exited with code {process.exitcode}, restarting it")
+                SHARD_RESTARTS.inc()
+                self.start_shard(index)
 
-        if not is_member:
+    def shard_of(self, chat_id):
+        return hash(chat_id) % len(self.pipes)
+
+    async def worker(self, queue):
+        index = self.queues.index(queue)
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < SHARD_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            now = time.monotonic()
+            self.waits.extend(now - item[0] for item in batch)
+            messages = [("check",) + item[1:] for item in batch]
             try:
-                await event.delete()
-            except Exception as e:
-                logger.error(f"Could not delete message: {e}")
+                await self.put(index, messages)
+            finally:
+                self.processed += len(batch)
+                for _ in batch:
+                    queue.task_done()
+
+    async def put(self, index, messages):
+        pipe = self.pipes[index]
+        try:
             try:
-                buttons = []
-                # Prepare join buttons for each channel
-                for c in forcesub_data['channels']:
-                    if c.get('link') and c.get('title'):
-                        buttons.append(Button.url("๏ ᴊᴏɪɴ ๏", c['link']))
-                
-                # Arrange buttons in 2 columns
-                join_buttons = []
-                for i in range(0, len(buttons), 2):
-                    join_buttons.append(buttons[i:i+2])
-                
-                # Get user object for mention
-                try:
-                    user = await event.get_sender()
-                    mention = f"[{user.first_name or 'User'}](tg://user?id={user.id})"
-                except Exception as e:
-                    logger.warning(f"Could not get user for mention: {e}")
-                    mention = "User"
-                
-                # Add confirm join button
-                join_buttons.append([Button.inline("ᴄᴏɴғɪʀᴍ ᴊᴏɪɴ", data=f"confirm_join_{chat_id}")])
-                
-                await event.reply(
-                    f"👋 **ʜᴇʟʟᴏ** {mention},\n\n"
-                    "**🚀 ғᴏʀᴄᴇ ᴀᴄᴄᴇss ᴜɴʟᴏᴄᴋ!**\n__🔐 ʏᴏᴜʀ ᴄʜᴀᴛ ɪs **ʀᴇsᴛʀɪᴄᴛᴇᴅ__**\n__👉 **Jᴏɪɴ ɴᴏᴡ** ᴛᴏ ᴄᴏɴᴛɪɴᴜᴇ ᴄʜᴀᴛᴛɪɴɢ!__**\n\n👇 ᴄʟɪᴄᴋ ʙᴇʟᴏᴡ ᴛᴏ Jᴏɪɴ 👇**:",
-                    buttons=join_buttons,
-                    link_preview=False
-                )
-            except Exception as e:
-                logger.error(f"An error occurred while sending the force sub message: {e}")
-            return
-    setattr(event, '_fsub_checked', True)
+                pipe.put_nowait(messages)
+            except Full:
+                await asyncio.get_running_loop().run_in_executor(self.executor, pipe.put, messages, True, SHARD_PUT_TIMEOUT)
+        except Full:
+            logger.error(f"Shard {index} took nothing for {SHARD_PUT_TIMEOUT}s, dropped {len(messages)} messages")
+        except Exception as e:
+            logger.error(f"Error forwarding {len(messages)} messages to shard {index}: {e}")
+
+    # Notices wait for room like checks do; a dropped leave would keep trust entries
+    # and cached memberships alive on the shard
+    def send(self, index, message):
+        spawn(self.put(index, [message]))
+
+    def joined(self, chat_id, user_id):
+        self.send(self.shard_of(chat_id), ("joined", chat_id, user_id))
+
+    def member_changed(self, user_id, keys, chats, joined):
+        for index in range(len(self.pipes)):
+            self.send(index, ("member", user_id, list(keys), list(chats), joined))
+
+    async def stop(self):
+        self.stopping = True
+        if self.watcher:
+            self.watcher.cancel()
+        await super().stop()
+        loop = asyncio.get_running_loop()
+        for index, pipe in enumerate(self.pipes):
+            try:
+                await loop.run_in_executor(self.executor, pipe.put, None, True, SHARD_PUT_TIMEOUT)
+            except Full:
+                logger.error(f"Shard {index} is not reading its pipe, terminating it")
+                self.processes[index].terminate()
+        for process in self.processes:
+            await loop.run_in_executor(self.executor, process.join, SHARD_PUT_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+if SHARDS > 1 and SHARD_INDEX is None:
+    enforcement_queue = ShardedEnforcementQueue(SHARDS, FSUB_QUEUE_SIZE, FSUB_OVERFLOW_POLICY, max_blocked=FSUB_MAX_BLOCKED)
+else:
+    enforcement_queue = EnforcementQueue(FSUB_WORKERS, FSUB_QUEUE_SIZE, FSUB_OVERFLOW_POLICY, stride=SHARD_COUNT, max_blocked=FSUB_MAX_BLOCKED)
+
+metrics.Gauge("fsub_enforcement_queue_depth", "Group messages waiting for a check", lambda: enforcement_queue.depth())
+metrics.Gauge("fsub_enforcement_processed_total", "Group messages taken off the queue", lambda: enforcement_queue.processed, kind="counter")
+metrics.Gauge("fsub_enforcement_blocked", "Update handlers waiting for room in a full queue", lambda: enforcement_queue.blocked)
+metrics.Gauge("fsub_enforcement_dropped_total", "Checks skipped by the overflow policy", lambda: enforcement_queue.dropped, kind="counter")
+
+# Applies messages forwarded by the receiver until it sends None
+async def consume_shard_pipe(pipe):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await loop.run_in_executor(None, pipe.get)
+        if batch is None:
+            break
+        for message in batch:
+            kind = message[0]
+            if kind == "check":
+                await enforcement_queue.submit(*message[1:])
+            elif kind == "joined":
+                _, chat_id, user_id = message
+                membership_cache.invalidate_negative(user_id)
+                clear_warning(chat_id, user_id)
+            elif kind == "member":
+                _, user_id, keys, chats, joined = message
+                for key in keys:
+                    membership_cache.set(user_id, key, joined)
+                enforcement_queue.member_changed(user_id, keys, chats, joined)
+    await enforcement_queue.stop()
+
+async def log_enforcement_queue():
+    last_processed = 0
+    while True:
+        await asyncio.sleep(60)
+        q = enforcement_queue
+        if q.processed != last_processed:
+            logger.info(
+                f"Enforcement queue: depth={q.depth()} max={q.max_depth} processed={q.processed - last_processed} "
+                f"wait p50={q.wait_percentile(50) * 1000:.0f}ms p99={q.wait_percentile(99) * 1000:.0f}ms dropped={q.dropped}"
+            )
+            last_processed = q.processed
+
+@app.on(events.NewMessage(func=lambda e: e.is_group))
+@timed_handler
+async def check_fsub_handler(event):
+    await state_ready.wait()
+    # Groups without an active config never reach the queue
+    forcesub_data = get_forcesub(event.chat_id)
+    if not forcesub_data or not forcesub_data.get("channels") or not forcesub_data.get("enabled", True):
+        return
+    # The sender comes with the update, so building the mention costs no RPC
+    name = getattr(event.sender, "first_name", None) or "User"
+    await enforcement_queue.submit(event.chat_id, event.sender_id, event.id, name)
+
+# Channels that force-sub depends on, by bare channel id, built lazily and dropped
+# whenever a config or resolved entity changes:
+# id -> {"keys": membership cache keys for the channel, "chats": groups requiring it}
+channel_index = None
+
+def get_channel_index():
+    global channel_index
+    if channel_index is not None:
+        return channel_index
+    index = {}
+
+    def add(ref, chat_id=None):
+        if isinstance(ref, int):
+            bare_id = channel_key(ref)
+        else:
+            entity = channel_entities.get(channel_key(ref))
+            if entity is None:
+                return  # indexed once the first membership check has resolved it
+            bare_id = entity.id
+        entry = index.setdefault(bare_id, {"keys": set(), "chats": set()})
+        entry["keys"].add(channel_key(ref))
+        if chat_id is not None:
+            entry["chats"].add(chat_id)
+
+    for chat_id, doc in forcesub_cache.items():
+        for channel in doc.get("channels") or ():
+            add(channel["id"], chat_id)
+    for ref in FSUB_IDS:
+        add(ref)
+    channel_index = index
+    return index
+
+def participant_is_member(participant):
+    if participant is None or isinstance(participant, types.ChannelParticipantLeft):
+        return False
+    if isinstance(participant, types.ChannelParticipantBanned):
+        return not participant.left  # restricted members are still members
+    return True
+
+# Join/leave updates arrive for channels where the bot is an admin; they update the
+# membership cache directly so nobody waits for a GetParticipantRequest to notice
+@app.on(events.Raw(types.UpdateChannelParticipant))
+@timed_handler
+async def handle_channel_participant(update):
+    await state_ready.wait()
+    entry = get_channel_index().get(update.channel_id)
+    if entry is None:
+        return
+    user_id = update.user_id
+    joined = participant_is_member(update.new_participant)
+    for key in entry["keys"]:
+        membership_cache.set(user_id, key, joined)
+        if shared_membership is not None:
+            spawn(shared_membership.set(user_id, key, joined))
+    enforcement_queue.member_changed(user_id, entry["keys"], entry["chats"], joined)
+    if not joined:
+        return
+    # Lift the prompt in groups whose channels are now all joined
+    for chat_id in entry["chats"]:
+        forcesub_data = get_forcesub(chat_id)
+        if forcesub_data and all(membership_cache.get(user_id, c["id"]) for c in forcesub_data["channels"]):
+            enforcement_queue.joined(chat_id, user_id)
 
 # Callback for confirm join button
 @app.on(events.CallbackQuery(pattern=r"confirm_join_(\-?\d+)"))
+@timed_handler
 async def confirm_join_handler(event):
+    await state_ready.wait()
     try:
         chat_id = int(event.pattern_match.group(1))
         user_id = event.sender_id
-        forcesub_data = await forcesub_collection.find_one({"chat_id": chat_id})
+        forcesub_data = get_forcesub(chat_id)
         if not forcesub_data:
             return await event.answer("ɴᴏ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ᴅᴀᴛᴀ ғᴏᴜɴᴅ.", alert=True)
-        is_member = True
-        for channel in forcesub_data["channels"]:
-            try:
-                if isinstance(channel["id"], int):
-                    await app(GetParticipantRequest(channel=channel["id"], participant=user_id))
-                else:
-                    channel_entity = await app.get_entity(channel["id"])
-                    await app(GetParticipantRequest(channel=channel_entity, participant=user_id))
-            except UserNotParticipantError:
-                is_member = False
-                break
+        # User claims to have joined, so stale "not a member" answers must not block them
+        membership_cache.invalidate_negative(user_id)
+        channel_ids = [channel["id"] for channel in forcesub_data["channels"]]
+        is_member = not await find_missing_channels(chat_id, channel_ids, user_id)
         if is_member:
+            enforcement_queue.joined(chat_id, user_id)
+            enforcement_stats.record(chat_id, "confirmed")
             await event.answer("ʏᴏᴜ ʜᴀᴠᴇ ᴊᴏɪɴᴇᴅ ᴀʟʀᴇᴀᴅʏ.", alert=True)
             try:
                 await app.send_message(user_id, "ᴛʜᴀɴᴋs ғᴏʀ ᴊᴏɪɴɪɴɢ!")
@@ -481,11 +2037,9 @@ async def confirm_join_handler(event):
         logger.error(f"Error in confirm_join_handler: {e}")
         await event.answer("❌ ᴀɴ ᴇʀʀᴏʀ occᴜʀᴇᴅ.", alert=True)
 
-@app.on(events.NewMessage(pattern=r"^/reset(?:@\w+)?$", func=lambda e: e.is_group))
+@command("reset", group_only=True)
 @check_fsub
 async def reset_forcesub(event):
-    if not await is_command_for_me(event):
-        return
     chat_id = event.chat_id
     user_id = event.sender_id
 
@@ -493,117 +2047,582 @@ async def reset_forcesub(event):
         return await event.reply("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
 
     await remove_group(chat_id)
-    await forcesub_collection.delete_one({"chat_id": chat_id})
+    await delete_forcesub(chat_id)
     await event.reply("**✅ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ʜᴀs ʙᴇᴇɴ ʀᴇsᴇᴛ ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ.**")
 
-@app.on(events.NewMessage(pattern=r"^/stats(?:@\w+)?$"))
+@command("stats")
 @check_fsub
 async def stats(event):
-    if not await is_command_for_me(event):
-        return
     if event.sender_id != OWNER_ID:
         return await event.reply("**🚫 ᴏɴʟʏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
 
-    total_users = len(await get_all_users())
-    total_groups = len(await get_all_groups())
-    banned_users = await banned_users_collection.count_documents({})
+    total_users, total_groups = await get_totals()
+    active_users, active_groups = await get_daily_activity(today())
+    banned_users = len(banned_user_ids)
     await event.reply(
         f"**📊 ʙᴏᴛ sᴛᴀᴛɪsᴛɪᴄs:**\n\n"
         f"**➲ ᴛᴏᴛᴀʟ ᴜsᴇʀs:** {total_users}\n"
         f"**➲ ᴛᴏᴛᴀʟ ɢʀᴏᴜᴘs:** {total_groups}\n"
+        f"**➲ ᴀᴄᴛɪᴠᴇ ᴜsᴇʀs ᴛᴏᴅᴀʏ:** {active_users}\n"
+        f"**➲ ᴀᴄᴛɪᴠᴇ ɢʀᴏᴜᴘs ᴛᴏᴅᴀʏ:** {active_groups}\n"
         f"**➲ ʙᴀɴɴᴇᴅ ᴜsᴇʀs:** {banned_users}"
     )
 
-@app.on(events.NewMessage(pattern=r"^/ban(?:@\w+)? (\d+)$"))
+@command("fsubstats", group_only=True)
+@check_fsub
+async def fsub_stats(event):
+    chat_id = event.chat_id
+    if not await is_admin_or_owner(chat_id, event.sender_id):
+        return await event.reply("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs, ᴀᴅᴍɪɴs ᴏʀ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
+
+    # Counts from the last few seconds are still in memory; write them first
+    await enforcement_stats.flush()
+    lines = ["**📊 ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ sᴛᴀᴛɪsᴛɪᴄs:**"]
+    for label, hours in (("ʟᴀsᴛ 24 ʜᴏᴜʀs", 24), ("ʟᴀsᴛ 7 ᴅᴀʏs", 24 * 7)):
+        totals = await enforcement_stats.totals(chat_id, hours)
+        converted = totals["confirmed"] / totals["warned"] if totals["warned"] else 0.0
+        lines += [
+            f"\n**❖ {label}:**",
+            f"**➲ ᴍᴇssᴀɢᴇs ᴄʜᴇᴄᴋᴇᴅ:** {totals['checked']}",
+            f"**➲ ᴍᴇssᴀɢᴇs ᴅᴇʟᴇᴛᴇᴅ:** {totals['deleted']}",
+            f"**➲ ᴊᴏɪɴ ᴘʀᴏᴍᴘᴛs sᴇɴᴛ:** {totals['warned']}",
+            f"**➲ ᴊᴏɪɴs ᴄᴏɴғɪʀᴍᴇᴅ:** {totals['confirmed']} ({converted:.0%})",
+        ]
+    await event.reply("\n".join(lines))
+
+# Busiest series of a histogram as "label: count, p50/p99" lines
+def histogram_lines(histogram, limit):
+    keys = sorted(histogram.series, key=histogram.count, reverse=True)[:limit]
+    return [
+        f"   • `{dict(key).popitem()[1] if key else 'all'}`: {histogram.count(key)}, "
+        f"{histogram.quantile(0.5, key) * 1000:.0f}/{histogram.quantile(0.99, key) * 1000:.0f}ms"
+        for key in keys
+    ]
+
+@command("perf")
+@check_fsub
+async def perf(event):
+    if event.sender_id != OWNER_ID:
+        return await event.reply("**🚫 ᴏɴʟʏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
+
+    uptime = int(time.monotonic() - STARTED_AT)
+    lookups = membership_cache.hits + membership_cache.misses
+    hit_ratio = membership_cache.hits / lookups if lookups else 0.0
+    q = enforcement_queue
+    sent = BROADCAST_MESSAGES.values.get(metrics.label_key({"result": "sent"}), 0)
+    lines = [
+        "**📈 ᴘᴇʀғᴏʀᴍᴀɴᴄᴇ:**\n",
+        f"**➲ ᴜᴘᴛɪᴍᴇ:** {uptime // 3600}h {uptime % 3600 // 60}m",
+        "**➲ ʜᴀɴᴅʟᴇʀs (count, p50/p99):**", *histogram_lines(HANDLER_SECONDS, 8),
+        "**➲ ᴛᴇʟᴇɢʀᴀᴍ ʀᴇǫᴜᴇsᴛs:**", *histogram_lines(RPC_SECONDS, 5),
+        f"**➲ ʀᴇǫᴜᴇsᴛ ᴇʀʀᴏʀs:** {RPC_ERRORS.total()}",
+        f"**➲ ғʟᴏᴏᴅ ᴡᴀɪᴛ:** {FLOOD_WAIT_SECONDS.total()}s",
+        f"**➲ sᴄʜᴇᴅᴜʟᴇʀ (waiting {app.gateway.depth()}, count, p50/p99):**", *histogram_lines(RPC_QUEUED, 3),
+        "**➲ ᴍᴏɴɢᴏ:**", *histogram_lines(MONGO_SECONDS, 5),
+        f"**➲ ᴍᴇᴍʙᴇʀ ᴄᴀᴄʜᴇ:** {hit_ratio:.1%} hits of {lookups}, {single_flight.coalesced} coalesced",
+        f"**➲ ǫᴜᴇᴜᴇ:** depth {q.depth()}, max {q.max_depth}, wait p99 {q.wait_percentile(99) * 1000:.0f}ms, dropped {q.dropped}",
+        f"**➲ ᴅᴇʟᴇᴛᴇᴅ:** {MESSAGES_DELETED.value(kind='message')}",
+        f"**➲ ʙʀᴏᴀᴅᴄᴀsᴛ sᴇɴᴛ:** {sent}",
+        f"**➲ ғɪʀsᴛ ᴜᴘᴅᴀᴛᴇ / ᴡᴀʀᴍ:** {FIRST_HANDLED or 0:.1f}s / {WARMED or 0:.1f}s after start",
+    ]
+    if active_broadcast is not None:
+        elapsed = max(time.monotonic() - active_broadcast.started, 1e-6)
+        rate = (active_broadcast.processed() - active_broadcast.processed_at_start) / elapsed
+        lines.append(f"**➲ ʙʀᴏᴀᴅᴄᴀsᴛ ʀᴀᴛᴇ:** {rate:.1f} msg/s")
+    await event.reply("\n".join(lines))
+
+@command("ban")
 @check_fsub
 async def ban_user(event):
-    if not await is_command_for_me(event):
-        return
     if event.sender_id != OWNER_ID:
         return await event.reply("**🚫 ᴏɴʟʏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
-    user_id = int(event.pattern_match.group(1))
-    await banned_users_collection.insert_one({"user_id": user_id})
+    if not event.command_args.isdigit():
+        return
+    user_id = int(event.command_args)
+    await banned_users_collection.update_one({"user_id": user_id}, {"$set": {"user_id": user_id}}, upsert=True)
+    banned_user_ids.add(user_id)
     await event.reply(f"**✅ ᴜsᴇʀ {user_id} ʜᴀs ʙᴇᴇɴ ʙᴀɴɴᴇᴅ.**")
 
-@app.on(events.NewMessage(pattern=r"^/unban(?:@\w+)? (\d+)$"))
+@command("unban")
 @check_fsub
 async def unban_user(event):
-    if not await is_command_for_me(event):
-        return
     if event.sender_id != OWNER_ID:
         return await event.reply("**🚫 ᴏɴʟʏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
-    user_id = int(event.pattern_match.group(1))
-    await banned_users_collection.delete_one({"user_id": user_id})
+    if not event.command_args.isdigit():
+        return
+    user_id = int(event.command_args)
+    await banned_users_collection.delete_many({"user_id": user_id})
+    banned_user_ids.discard(user_id)
     await event.reply(f"**✅ ᴜsᴇʀ {user_id} ʜᴀs ʙᴇᴇɴ ᴜɴᴀʙɴᴇᴅ.**")
 
-@app.on(events.NewMessage(pattern=r"^/(broadcast|gcast)(?:@\w+)?( .*)?$"))
+# Errors that mean a recipient will never accept a message again, by failure reason
+DEAD_RECIPIENT_ERRORS = (
+    (UserIsBlockedError, "blocked"),
+    (InputUserDeactivatedError, "deactivated"),
+    (ChannelPrivateError, "kicked"),
+    (ChatWriteForbiddenError, "kicked"),
+    (PeerIdInvalidError, "not_found"),
+    (ChatIdInvalidError, "not_found"),
+    (ChannelInvalidError, "not_found"),
+)
+
+def dead_recipient_reason(error):
+    for error_type, reason in DEAD_RECIPIENT_ERRORS:
+        if isinstance(error, error_type):
+            return reason
+    return None
+
+# Extra bot sessions (BROADCAST_TOKENS) that share the sending of broadcasts. A helper
+# bot can only reach users who started it and groups it is in; anything it can't
+# deliver is sent by the main bot instead. Recipients a helper was refused by keep
+# its bot id in unreachable_by and go straight to the main bot in later broadcasts.
+broadcast_clients = []
+
+async def start_broadcast_clients():
+    for i, token in enumerate(BROADCAST_TOKENS):
+        client = InstrumentedClient(f"broadcast{i}", api_id=API_ID, api_hash=API_HASH, receive_updates=False)
+        client.helper_id = int(token.split(":")[0])
+        try:
+            await client.start(bot_token=token)
+            broadcast_clients.append(client)
+        except Exception as e:
+            logger.error(f"Could not start broadcast session {i}: {e}")
+    if broadcast_clients:
+        logger.info(f"Started {len(broadcast_clients)} extra broadcast sessions")
+
+# A helper session has no access hashes for our recipients; bots may use 0 instead
+def bot_input_peer(chat_id):
+    real_id, peer_type = utils.resolve_id(chat_id)
+    if peer_type is types.PeerUser:
+        return types.InputPeerUser(real_id, 0)
+    if peer_type is types.PeerChat:
+        return types.InputPeerChat(real_id)
+    return types.InputPeerChannel(real_id, 0)
+
+# One bot session sending a broadcast, with its own pacing and flood-wait state
+class BroadcastLeaseLost(Exception):
+    pass
+
+class BroadcastSender:
+    def __init__(self, client, main, helper_id=None):
+        self.client = client
+        self.main = main
+        self.helper_id = helper_id
+        self.bucket = TokenBucket(BROADCAST_RATE)
+
+# Recipients are streamed in _id order, groups first. A checkpoint stores the last _id
+# below which everything is finished, plus the few finished _ids beyond it.
+BROADCAST_STAGES = (("groups", groups_collection, "group_id"), ("users", users_collection, "user_id"))
+active_broadcast = None
+
+class Broadcast:
+    def __init__(self, doc):
+        self.doc = doc
+        self.senders = [BroadcastSender(app, main=True)]
+        self.copy = None  # (text, entities) helper sessions send, as they can't forward
+        self.queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 4)
+        self.order = deque()  # [_id, done] in stream order, used to advance last_id
+        self.skip = set(doc.get("done_ahead") or ())
+        self.prune_ops = {stage: [] for stage, _, _ in BROADCAST_STAGES}
+        self.unreachable_ops = {stage: [] for stage, _, _ in BROADCAST_STAGES}
+        doc.setdefault("pruned", 0)
+        doc.setdefault("failures", {})
+        doc.setdefault("helper_sent", 0)
+        self.started = time.monotonic()
+        self.processed_at_start = self.processed()
+        self.last_progress = self.started
+        self.lost = False  # another instance took the broadcast over
+
+    def processed(self):
+        return self.doc["sent_groups"] + self.doc["sent_users"] + self.doc["failed"]
+
+    async def run(self):
+        rpc_priority.set(PRIORITY_LOW)
+        self.task = asyncio.current_task()
+        await self.add_helpers()
+        workers = [asyncio.ensure_future(self.worker(sender)) for sender in self.senders for _ in range(BROADCAST_WORKERS)]
+        ticker = asyncio.ensure_future(self.tick())
+        try:
+            stages = [stage for stage, _, _ in BROADCAST_STAGES]
+            for stage, collection, field in BROADCAST_STAGES[stages.index(self.doc["stage"]):]:
+                if self.doc["stage"] != stage:
+                    self.doc["stage"] = stage
+                    self.doc["last_id"] = None
+                query = dict(ACTIVE)
+                if self.doc["last_id"] is not None:
+                    query["_id"] = {"$gt": self.doc["last_id"]}
+                async for record in collection.find(query, {field: 1, "unreachable_by": 1}).sort("_id", 1):
+                    if record["_id"] in self.skip:
+                        continue
+                    entry = [record["_id"], False]
+                    self.order.append(entry)
+                    await self.queue.put((entry, stage, record.get(field), record.get("unreachable_by") or ()))
+                await self.queue.join()
+                await self.save_checkpoint()
+            self.doc["status"] = "done"
+        finally:
+            ticker.cancel()
+            for worker in workers:
+                worker.cancel()
+            if not self.lost:
+                await self.save_checkpoint()
+        failures = "\n".join(f"**   • {reason}:** {count}" for reason, count in sorted(self.doc["failures"].items()))
+        await self.edit_progress(
+            f"**✅ ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴏᴍᴍʀᴇᴛᴇᴅ.**\n\n"
+            f"**👥 ɢʀᴏᴜᴘs sᴇɴᴛ:** {self.doc['sent_groups']}\n"
+            f"**🧑‍💻 ᴜsᴇʀs sᴇɴᴛ:** {self.doc['sent_users']}\n"
+            f"**📌 ᴘɪɴɴᴇᴅ:** {self.doc['pinned']}\n"
+            f"**❌ ғᴀɪʟᴇᴅ:** {self.doc['failed']}\n"
+            + (f"{failures}\n" if failures else "")
+            + f"**🧹 ᴘʀᴜɴᴇᴅ:** {self.doc['pruned']}"
+            + (f"\n**🤖 sᴇɴᴛ ʙʏ ʜᴇʟᴘᴇʀ ʙᴏᴛs:** {self.doc['helper_sent']}" if self.doc["helper_sent"] else "")
+        )
+
+    # Helper sessions join in when the message can be re-sent as text; media and
+    # forwards of messages they can't see stay with the main session
+    async def add_helpers(self):
+        if not broadcast_clients:
+            return
+        if self.doc.get("message_id"):
+            try:
+                message = await app.get_messages(self.doc["from_chat"], ids=self.doc["message_id"])
+            except Exception as e:
+                logger.warning(f"Could not load broadcast message for helper sessions: {e}")
+                return
+            if message is None or message.media or not message.message:
+                logger.info("Broadcast message has media, sending it from the main session only")
+                return
+            self.copy = (message.message, message.entities)
+        else:
+            self.copy = (self.doc["text"], None)
+        self.senders += [BroadcastSender(client, main=False, helper_id=client.helper_id) for client in broadcast_clients]
+
+    async def worker(self, sender):
+        while True:
+            entry, stage, chat_id, unreachable = await self.queue.get()
+            try:
+                if chat_id is not None:
+                    await self.deliver(sender, stage, chat_id, unreachable)
+                    BROADCAST_MESSAGES.inc(result="sent")
+            except Exception as e:
+                reason = dead_recipient_reason(e)
+                BROADCAST_MESSAGES.inc(result=reason or "other")
+                if reason is None:
+                    logger.error(f"Failed to send broadcast to {chat_id}: {e}")
+                self.doc["failed"] += 1
+                self.doc["failures"][reason or "other"] = self.doc["failures"].get(reason or "other", 0) + 1
+                if reason is not None:
+                    await self.prune(stage, chat_id, reason)
+            finally:
+                entry[1] = True
+                while self.order and self.order[0][1]:
+                    self.doc["last_id"] = self.order.popleft()[0]
+                self.queue.task_done()
+
+    # The only retry loop for a broadcast message: the gateway's is turned off here
+    async def send(self, sender, chat_id):
+        token = rpc_retry.set(False)
+        try:
+            return await self.send_with_retries(sender, chat_id)
+        finally:
+            rpc_retry.reset(token)
+
+    async def send_with_retries(self, sender, chat_id):
+        for _ in range(BROADCAST_MAX_RETRIES):
+            await sender.bucket.acquire()
+            try:
+                if not sender.main:
+                    text, entities = self.copy
+                    msg = await sender.client.send_message(bot_input_peer(chat_id), text, formatting_entities=entities)
+                elif self.doc.get("message_id"):
+                    msg = await app.forward_messages(chat_id, self.doc["message_id"], self.doc["from_chat"])
+                else:
+                    msg = await app.send_message(chat_id, self.doc["text"])
+            except FloodWaitError as e:
+                logger.warning(f"Flood wait of {e.seconds}s during broadcast, backing off")
+                sender.bucket.flood_wait(e.seconds)
+                if not sender.main:
+                    raise  # the main bot sends it rather than waiting for the helper
+                continue
+            sender.bucket.success()
+            return msg
+        raise RuntimeError(f"gave up after {BROADCAST_MAX_RETRIES} flood waits")
+
+    async def deliver(self, sender, stage, chat_id, unreachable):
+        if not sender.main and sender.helper_id in unreachable:
+            sender = self.senders[0]
+        if sender.main:
+            msg = await self.send(sender, chat_id)
+        else:
+            try:
+                msg = await self.send(sender, chat_id)
+                self.doc["helper_sent"] += 1
+            except Exception as e:
+                # Only main-session errors count as failures
+                if isinstance(e, RPCError) and not isinstance(e, FloodWaitError):
+                    self.mark_unreachable(stage, chat_id, sender.helper_id)
+                sender = self.senders[0]
+                msg = await self.send(sender, chat_id)
+        if isinstance(chat_id, int) and chat_id < 0:
+            # Telegram allows about one message per second in a single chat
+            await asyncio.sleep(1)
+            try:
+                await sender.bucket.acquire()
+                await sender.client.pin_message(chat_id if sender.main else bot_input_peer(chat_id), msg.id, notify=False)
+                self.doc["pinned"] += 1
+            except Exception:
+                pass
+            self.doc["sent_groups"] += 1
+        else:
+            self.doc["sent_users"] += 1
+
+    async def prune(self, stage, chat_id, reason):
+        field = dict((s, f) for s, _, f in BROADCAST_STAGES)[stage]
+        self.prune_ops[stage].append(UpdateOne({field: chat_id}, {"$set": {"inactive": True, "inactive_reason": reason}}))
+        (group_tracker if stage == "groups" else user_tracker).forget(chat_id)
+        self.doc["pruned"] += 1
+        if len(self.prune_ops[stage]) >= PRUNE_BATCH_SIZE:
+            await self.flush_prunes()
+
+    def mark_unreachable(self, stage, chat_id, helper_id):
+        field = dict((s, f) for s, _, f in BROADCAST_STAGES)[stage]
+        self.unreachable_ops[stage].append(UpdateOne({field: chat_id}, {"$addToSet": {"unreachable_by": helper_id}}))
+
+    async def flush_prunes(self):
+        for stage, collection, _ in BROADCAST_STAGES:
+            ops, self.unreachable_ops[stage] = self.unreachable_ops[stage], []
+            if ops:
+                try:
+                    await collection.bulk_write(ops, ordered=False)
+                except PyMongoError as e:
+                    logger.error(f"Error saving {len(ops)} {stage} unreachable by helper bots: {e}")
+        for stage, collection, _ in BROADCAST_STAGES:
+            ops, self.prune_ops[stage] = self.prune_ops[stage], []
+            if ops:
+                try:
+                    result = await collection.bulk_write(ops, ordered=False)
+                    await bump_total(stage, -result.modified_count)
+                except PyMongoError as e:
+                    logger.error(f"Error marking {len(ops)} dead {stage} inactive: {e}")
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            try:
+                await self.save_checkpoint()
+            except PyMongoError as e:
+                logger.error(f"Error saving broadcast checkpoint: {e}")
+            except BroadcastLeaseLost as e:
+                logger.warning(f"Stopping broadcast {self.doc['_id']}: {e}")
+                self.task.cancel()
+                return
+            if time.monotonic() - self.last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                self.last_progress = time.monotonic()
+                await self.edit_progress(self.progress_text())
+
+    def progress_text(self):
+        done = self.processed()
+        rate = (done - self.processed_at_start) / max(time.monotonic() - self.started, 1e-6)
+        remaining = max(self.doc["total"] - done, 0)
+        eta = f"{int(remaining / rate) // 60}m {int(remaining / rate) % 60}s" if rate > 0 else "—"
+        return (
+            f"**❖ ʙʀᴏᴀᴅᴄᴀsᴛɪɴɢ...**\n\n"
+            f"**➲ ᴘʀᴏɢʀᴇss:** {done}/{self.doc['total']}\n"
+            f"**➲ ғᴀɪʟᴇᴅ:** {self.doc['failed']}\n"
+            f"**➲ ʀᴀᴛᴇ:** {rate:.1f} msg/s\n"
+            f"**➲ ᴇᴛᴀ:** {eta}"
+        )
+
+    async def edit_progress(self, text):
+        try:
+            await app.edit_message(self.doc["progress_chat"], self.doc["progress_msg"], text)
+        except Exception as e:
+            logger.warning(f"Could not update broadcast progress: {e}")
+
+    async def save_checkpoint(self):
+        # Pruned records are written first so a resumed run does not count them again
+        await self.flush_prunes()
+        fields = {k: self.doc[k] for k in ("status", "stage", "last_id", "sent_groups", "sent_users", "failed", "pinned", "pruned", "failures", "helper_sent")}
+        fields["done_ahead"] = [doc_id for doc_id, done in self.order if done]
+        # Each checkpoint renews the lease; a lease that ran out may have been claimed
+        # by another instance, which then owns the progress fields
+        fields["lease_until"] = datetime.utcnow() + timedelta(seconds=BROADCAST_LEASE)
+        result = await broadcasts_collection.update_one({"_id": self.doc["_id"], "owner": INSTANCE_ID}, {"$set": fields})
+        if result.matched_count == 0:
+            self.lost = True
+            raise BroadcastLeaseLost("its lease was taken over by another instance")
+
+async def run_broadcast(doc):
+    global active_broadcast
+    active_broadcast = Broadcast(doc)
+    try:
+        await active_broadcast.run()
+    except Exception as e:
+        logger.error(f"Broadcast {doc['_id']} stopped: {e}")
+    finally:
+        active_broadcast = None
+
+# Takes a running broadcast nobody holds a live lease on, in one write so two
+# instances can't both take it
+async def claim_broadcast():
+    now = datetime.utcnow()
+    return await broadcasts_collection.find_one_and_update(
+        {"status": "running", "$or": [{"owner": None}, {"lease_until": {"$lt": now}}]},
+        {"$set": {"owner": INSTANCE_ID, "lease_until": now + timedelta(seconds=BROADCAST_LEASE)}},
+        sort=[("_id", -1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+# Picks up a broadcast that was still running when its instance went down, once its
+# lease runs out
+async def resume_broadcasts():
+    while True:
+        if active_broadcast is None:
+            try:
+                doc = await claim_broadcast()
+            except PyMongoError as e:
+                logger.error(f"Error claiming a broadcast to resume: {e}")
+            else:
+                if doc:
+                    logger.info(f"Resuming broadcast {doc['_id']} from {doc['stage']} after {doc['last_id']}")
+                    spawn(run_broadcast(doc))
+        await asyncio.sleep(BROADCAST_LEASE)
+
+@command("broadcast", "gcast")
 @check_fsub
 async def broadcast(event):
-    if not await is_command_for_me(event):
-        return
     if event.sender_id != OWNER_ID:
         return await event.reply("**🚫 ᴏɴʟʏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
-    reply = event.reply_to_message if hasattr(event, 'reply_to_message') else None
-    text = event.pattern_match.group(2)
-    if not reply and not text:
+    if active_broadcast is not None or await broadcasts_collection.find_one({"status": "running", "lease_until": {"$gte": datetime.utcnow()}}):
+        return await event.reply("**❖ ᴀ ʙʀᴏᴀᴅᴄᴀsᴛ ɪs ᴀʟʀᴇᴀᴅʏ ʀᴜɴɴɪɴɢ.**")
+    reply_id = event.reply_to_msg_id
+    text = event.command_args
+    if not reply_id and not text:
         return await event.reply("**❖ ʀᴇᴘʟʏ ᴛᴏ ᴀ ᴍᴇssᴀɢᴇ ᴏʀ ᴘʀᴏᴠɪᴅᴇ ᴛᴇxᴛ ᴛᴏ ʙʀᴏᴀᴅᴄᴀsᴛ.**")
     progress_msg = await event.reply("**❖ ʙʀᴏᴀᴅᴄᴀsᴛɪɴɢ ᴍᴇssᴀɢᴇ ᴘʟᴇᴀsᴇ ᴡᴀɪᴛ...**")
-    sent_groups, sent_users, failed, pinned = 0, 0, 0, 0
-    users = await get_all_users()
-    groups = await get_all_groups()
-    recipients = groups + users
-    for chat_id in recipients:
-        try:
-            if reply:
-                msg = await event.reply_to_message.forward(chat_id)
-            else:
-                msg = await app.send_message(chat_id, text.strip())
-            if isinstance(chat_id, int) and chat_id < 0:
-                try:
-                    await app.pin_message(chat_id, msg.id, notify=False)
-                    pinned += 1
-                except Exception:
-                    pass
-                sent_groups += 1
-            else:
-                sent_users += 1
-            await asyncio.sleep(0.2)
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {chat_id}: {e}")
-            failed += 1
-    await progress_msg.edit(
-        f"**✅ ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴏᴍᴍʀᴇᴛᴇᴅ.**\n\n"
-        f"**👥 ɢʀᴏᴜᴘs sᴇɴᴛ:** {sent_groups}\n"
-        f"**🧑‍💻 ᴜsᴇʀs sᴇɴᴛ:** {sent_users}\n"
-        f"**📌 ᴘɪɴɴᴇᴅ:** {pinned}\n"
-        f"**❌ ғᴀɪʟᴇᴅ:** {failed}"
-    )
-
-@app.on(events.NewMessage(func=lambda e: e.is_private))
-async def check_ban(event):
-    if await banned_users_collection.find_one({"user_id": event.sender_id}):
-        return await event.reply("**🚫 ʏᴏᴜ ᴀʀᴇ ʙᴀɴɴᴇᴅ ғʀᴏᴍ ᴜsɪɴɢ ᴛʜɪs ʙᴏᴛ.**")
+    doc = {
+        "status": "running",
+        "text": None if reply_id else text,
+        "from_chat": event.chat_id if reply_id else None,
+        "message_id": reply_id,
+        "progress_chat": event.chat_id,
+        "progress_msg": progress_msg.id,
+        "stage": BROADCAST_STAGES[0][0],
+        "last_id": None,
+        "total": sum(await get_totals()),
+        "sent_groups": 0,
+        "sent_users": 0,
+        "failed": 0,
+        "pinned": 0,
+        "pruned": 0,
+        "failures": {},
+        "started_at": datetime.utcnow(),
+        "owner": INSTANCE_ID,
+        "lease_until": datetime.utcnow() + timedelta(seconds=BROADCAST_LEASE),
+    }
+    result = await broadcasts_collection.insert_one(doc)
+    doc["_id"] = result.inserted_id
+    spawn(run_broadcast(doc))
 
 @app.on(events.NewMessage)
+@timed_handler
 async def handle_new_message(event):
     if event.is_private:
-        await add_user(event.sender_id)
+        add_user(event.sender_id)
     elif event.is_group:
-        await add_group(event.chat_id)
+        add_group(event.chat_id)
 
 async def startup_notification():
     try:
-        total_users = len(await get_all_users())
-        total_groups = len(await get_all_groups())
-        await app.send_message(LOGGER_ID, "**✅ ʙᴏᴛ ʜᴀs sᴛᴀʀᴛᴇᴅ sᴜᴄᴄᴇssғᴜʀʀʏ!**\n\n**ʙᴏᴛ ɪɴғᴏ:**\n**➲ ᴏᴡɴᴇʀ ɪᴅ:** `" + str(OWNER_ID) + "`\n**➲ ʟᴏɢɢᴇʀ ɪᴅ:** `" + str(LOGGER_ID) + "`\n**➲ ᴛᴏᴛᴀʟ ᴜsᴇʀs:** `" + str(total_users) + "`\n**➲ ᴛᴏᴛᴀʟ ɢʀᴏᴜᴘs:** `" + str(total_groups) + "`")
+        total_users, total_groups = await get_totals()
+        log_pipeline.submit("**✅ ʙᴏᴛ ʜᴀs sᴛᴀʀᴛᴇᴅ sᴜᴄᴄᴇssғᴜʀʀʏ!**\n\n**ʙᴏᴛ ɪɴғᴏ:**\n**➲ ᴏᴡɴᴇʀ ɪᴅ:** `" + str(OWNER_ID) + "`\n**➲ ʟᴏɢɢᴇʀ ɪᴅ:** `" + str(LOGGER_ID) + "`\n**➲ ᴛᴏᴛᴀʟ ᴜsᴇʀs:** `" + str(total_users) + "`\n**➲ ᴛᴏᴛᴀʟ ɢʀᴏᴜᴘs:** `" + str(total_groups) + "`", high=True)
     except Exception as e:
         logger.error(f"Error sending startup notification: {e}")
 
-async def main():
+# Entry point of a shard process started by ShardedEnforcementQueue
+async def shard_main(index, pipe):
     await app.start(bot_token=BOT_TOKEN)
+    await load_forcesub_cache()
+    state_ready.set()
+    spawn(watch_forcesub_changes())
+    spawn(expire_warnings())
+    enforcement_queue.start()
+    spawn(log_enforcement_queue())
+    spawn(flush_trackers_periodically())
+    metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT + 1 + index) if METRICS_PORT else None
+    logger.info(f"Shard {index} is running.")
+    try:
+        await consume_shard_pipe(pipe)
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        await flush_trackers()
+        await app.disconnect()
+
+def run_shard(index, pipe):
+    try:
+        asyncio.run(shard_main(index, pipe))
+    except KeyboardInterrupt:
+        pass
+
+# Everything the first updates can do without, run after they are already being handled
+# Retries a startup step that only needs MongoDB until the database answers
+async def retry_mongo(func):
+    while True:
+        try:
+            return await func()
+        except PyMongoError as e:
+            logger.error(f"Error in {func.__name__}, retrying: {e}")
+            await asyncio.sleep(5)
+
+async def prepare_database():
+    await retry_mongo(ensure_indexes)
+    await retry_mongo(init_totals)
+
+async def warm_up():
+    global WARMED
+    # Warm-up competes with live traffic right after a restart, so it yields to it
+    rpc_priority.set(PRIORITY_LOW)
+    await state_ready.wait()
+    spawn(watch_forcesub_changes())
+    spawn(expire_warnings())
+    spawn(log_enforcement_queue())
+    spawn(refresh_owner_channels_periodically())
+    database_ready = spawn(prepare_database())
+    # Each step on its own, so one failing doesn't skip the ones after it
+    for step in (refresh_owner_channels, warm_channel_entities, start_broadcast_clients):
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"Error while warming up ({step.__name__}): {e}")
+    get_channel_index()
+    await database_ready
+    spawn(resume_broadcasts())
+    WARMED = time.monotonic() - STARTED_AT
+    logger.info(f"Caches warm {WARMED:.2f}s after start")
     await startup_notification()
+
+async def main():
+    metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    await app.start(bot_token=BOT_TOKEN)
+    # Before any command is dispatched, so /cmd@otherbot is never taken for ours
+    await load_bot_identity()
+    enforcement_queue.start()
+    spawn(log_pipeline.run())
+    spawn(flush_trackers_periodically())
+    spawn(load_state())
+    spawn(warm_up())
     logger.info("Bot is running.")
-    await app.run_until_disconnected()
+    try:
+        await app.run_until_disconnected()
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        try:
+            await asyncio.wait_for(enforcement_queue.stop(), SHARD_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Enforcement queue did not drain before shutdown")
+        await flush_trackers()
 
 if __name__ == "__main__":
     logger.info("Starting the bot...")
@@ -0,0 +1,157 @@
+import asyncio, time, logging
+
+logger = logging.getLogger("DURGESH")
+
+# Minimal Prometheus-style metrics: counters, histograms and gauges read from a
+# function, rendered in the text exposition format. Labels are passed as keywords.
+registry = []
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}  # label key -> value
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def value(self, **labels):
+        return self.values.get(label_key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+# Latency buckets in seconds, from a cache hit to a slow flood-throttled request
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}  # label key -> [bucket counts..., +Inf count, sum]
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def count(self, key):
+        series = self.series.get(key)
+        return sum(series[:-1]) if series else 0
+
+    # Estimated from the buckets, like histogram_quantile() in Prometheus
+    def quantile(self, q, key):
+        series = self.series.get(key)
+        if not series:
+            return 0.0
+        target = q * self.count(key)
+        seen = 0
+        lower = 0.0
+        for i, bound in enumerate(self.buckets):
+            if series[i] and seen + series[i] >= target:
+                return lower + (bound - lower) * (target - seen) / series[i]
+            seen += series[i]
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{format_labels(key, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+# A value read when metrics are rendered; kind="counter" for values that only grow,
+# such as counters kept by other objects
+class Gauge:
+    def __init__(self, name, help, read, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+        registry.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {self.read()}"]
+
+def render():
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logger.error(f"Error rendering metric {metric.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+async def handle_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # headers are not needed
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_request, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server